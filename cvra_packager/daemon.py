@@ -0,0 +1,212 @@
+"""
+Long running packager process keeping the parsed package files and the
+resolved context in memory, so that editor integrations, build wrappers and
+the packager command line do not resolve the dependency graph from cold.
+
+The daemon listens on a Unix socket in the package directory. Requests and
+responses are single lines of JSON. A request is an object with a "command"
+key, which can be:
+
+- "context": returns the resolved template context under "context".
+- "render": downloads missing dependencies and renders the build files.
+- "ping": does nothing, used to check that the daemon is running.
+- "stop": stops the daemon.
+
+Errors are returned as an object with an "error" key.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from .packager import DAEMON_SOCKET, UNITY_DIR, clone, submodule_add, load_package_file
+from .packager import create_filemap, generate_context, render_build_files
+from .packager import file_stamp, list_dependencies, pkgfile_for_package
+from .packager import scanned_directories, enable_package_cache
+
+
+def serialize_context(context):
+    """
+    Converts a template context to plain JSON types. The test include
+    directories, which are an attribute of include_directories, are stored
+    under the "include_directories.test" key.
+    """
+    result = dict(context)
+    result['include_directories'] = list(context['include_directories'])
+    result['include_directories.test'] = list(context['include_directories'].test)
+    return result
+
+
+class PackagerState:
+    """
+    Resolved context of the package in the current directory, along with the
+    stamps of the package files it was resolved from.
+    """
+    def __init__(self):
+        self.package = None
+        self.filemap = None
+        self.context = None
+        self.stamps = None
+
+    def package_files(self):
+        """
+        Returns the package files the current context depends on.
+        """
+        files = ["package.yml"]
+
+        for dep, _ in list_dependencies(self.package, self.filemap):
+            files.append(pkgfile_for_package(dep, self.filemap))
+
+        return files
+
+    def generated_files(self):
+        """
+        Returns the files written while resolving the current context, which
+        must be written again if they are removed, for example by rm -rf build.
+        """
+        files = list()
+        unity = self.context.get('unity')
+
+        if unity is not None:
+            compiled = unity['source'] + unity['tests']
+            for target in unity['target'].values():
+                compiled += target
+            files += [f for f in compiled if os.path.dirname(f) == UNITY_DIR]
+
+        if 'precompiled_header' in self.context:
+            files.append(self.context['precompiled_header'])
+
+        files += self.context.get('target_precompiled_header', dict()).values()
+
+        return files
+
+    def current_stamps(self):
+        # Directories scanned for glob patterns change when files are added
+        paths = self.package_files() + scanned_directories() + self.generated_files()
+        return {path: file_stamp(path) for path in paths}
+
+    def resolve(self, download_method=clone):
+        """
+        Returns the resolved context, resolving it again only if a package
+        file or a generated file changed since the last resolution.
+        """
+        if self.stamps is not None and self.current_stamps() == self.stamps:
+            return self.context
+
+        self.package = load_package_file()
+        self.filemap = create_filemap(self.package)
+        self.context = generate_context(self.package, self.filemap, download_method)
+        self.stamps = self.current_stamps()
+
+        return self.context
+
+    def render(self, download_method=clone):
+        """
+        Renders the build files from the resolved context.
+        """
+        context = self.resolve(download_method)
+        render_build_files(self.package, context)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.dispatch(json.loads(line.decode()))
+            except Exception as e:
+                response = {'error': str(e)}
+
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            self.wfile.flush()
+
+
+class PackagerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    # Lets the main loop notice stop requests even without new connections
+    timeout = 0.5
+
+    def __init__(self, socket_path):
+        super().__init__(socket_path, RequestHandler)
+        self.state = PackagerState()
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def dispatch(self, request):
+        # Clients are served concurrently but the state is not thread-safe
+        with self.lock:
+            return self.dispatch_locked(request)
+
+    def dispatch_locked(self, request):
+        command = request.get('command')
+        method = submodule_add if request.get('submodules') else clone
+
+        if command == 'ping':
+            return {}
+
+        if command == 'context':
+            return {'context': serialize_context(self.state.resolve(method))}
+
+        if command == 'render':
+            self.state.render(method)
+            return {}
+
+        if command == 'stop':
+            self.stopped = True
+            return {}
+
+        raise ValueError("Unknown command: {}".format(command))
+
+
+def serve(socket_path=DAEMON_SOCKET):
+    """
+    Answers requests on the Unix socket at socket_path until a stop request is
+    received.
+    """
+    # Removes the socket of a daemon which was not stopped properly
+    if os.path.exists(socket_path):
+        try:
+            request('ping', socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise RuntimeError("A daemon is already running on {}".format(socket_path))
+
+    # Package files are only parsed again when they change
+    enable_package_cache()
+    server = PackagerServer(socket_path)
+
+    try:
+        while not server.stopped:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def request(command, socket_path=DAEMON_SOCKET, **arguments):
+    """
+    Sends a request to the daemon listening on socket_path and returns its
+    response.
+
+    Raises OSError if no daemon is listening and RuntimeError if the daemon
+    could not process the request.
+    """
+    message = dict(arguments, command=command)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps(message) + '\n').encode())
+            stream.flush()
+            response = json.loads(stream.readline().decode())
+
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+
+    return response
@@ -1,18 +1,44 @@
 #!/usr/bin/env python3
-import yaml
 import os.path
-import subprocess
-import jinja2
-import argparse
 from collections import defaultdict
+from contextlib import contextmanager
 import sys
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where concurrent runs are not synchronized
+    fcntl = None
+
 if sys.version_info.major != 3 or sys.version_info.minor < 4:
     raise RuntimeError("packager requires Python 3.4 or greater")
 
 
 BUILD_DIR = "build/"
 DEPENDENCIES_DIR = "dependencies"
+UNITY_DIR = os.path.join(BUILD_DIR, "unity")
+NINJA_BUILD_DIR = os.path.join(BUILD_DIR, "ninja")
+RENDER_CACHE = ".packager-cache.json"
+DAEMON_SOCKET = ".packager.sock"
+COMPILE_COMMANDS = "compile_commands.json"
+BUNDLE_MANIFEST = "packager-bundle.json"
+UNITY_BATCH_SIZE = 8
+PRECOMPILED_HEADER = os.path.join(BUILD_DIR, "pch", "precompiled.hpp")
+
+COMPILED_EXTENSIONS = ('.c', '.cpp', '.cc', '.cxx', '.s', '.S')
+
+# Categories of files every package has, even when its package.yml omits them
+PACKAGE_CATEGORIES = ["source", "tests", "include_directories", "include_directories.test"]
+
+# Test files defining the main() of the test executables, such as the one of
+# the test-runner package. They are compiled in every test shard.
+TEST_MAIN = ["main.cpp"]
+
+# Maps a target architecture (the part after "target.") to the prefix of its
+# GCC toolchain. Architectures which are not listed use the host compiler.
+TOOLCHAIN_PREFIXES = {
+    "arm": "arm-none-eabi-",
+}
 
 def url_for_package(package):
     """
@@ -69,19 +95,160 @@ def package_name_from_desc(package):
 
     return list(package.keys())[0]
 
+@contextmanager
+def dependency_lock(path):
+    """
+    Holds an exclusive lock on the dependency located at path, shared by all
+    packager processes running on this machine. The lock file is a hidden file
+    next to path.
+    """
+    directory, name = os.path.split(os.path.normpath(path))
+    lock_path = os.path.join(directory, ".{}.lock".format(name))
+
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    with open(lock_path, "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+def fetch_atomically(dest, fetch):
+    """
+    Calls fetch with a temporary path next to dest, then renames it to dest if
+    fetch returned True.
+
+    This happens while holding the dependency lock of dest, and is skipped if
+    dest exists once the lock is acquired. Concurrent packager runs therefore
+    wait for and reuse a single fetch, and never see a partial dest.
+    """
+    import shutil
+
+    with dependency_lock(dest):
+        if os.path.exists(dest):
+            return
+
+        directory, name = os.path.split(os.path.normpath(dest))
+        tmp = os.path.join(directory, ".{}.tmp-{}".format(name, os.getpid()))
+        shutil.rmtree(tmp, ignore_errors=True)
+
+        try:
+            if fetch(tmp) and os.path.exists(tmp):
+                os.rename(tmp, dest)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
 def clone(url, dest):
     """
     Git clones the given URL to the given destination path.
     """
-    command = "git clone --recursive {url} {path}".format(url=url, path=dest)
-    subprocess.call(command.split())
+    import subprocess
+
+    def fetch(path):
+        command = "git clone --recursive {url} {path}".format(url=url, path=path)
+        return subprocess.call(command.split()) == 0
+
+    fetch_atomically(dest, fetch)
 
 def submodule_add(url, dest):
     """
     Adds a git submodule with the given url at the dest path.
     """
-    command = "git submodule add {url} {path}".format(url=url, path=dest)
-    subprocess.call(command.split())
+    import subprocess
+
+    with dependency_lock(dest):
+        if os.path.exists(dest):
+            return
+
+        command = "git submodule add {url} {path}".format(url=url, path=dest)
+        subprocess.call(command.split())
+
+def is_sparse(package):
+    """
+    Returns True if the package description asks for a sparse checkout.
+    Example : my_package = {"chibios":{"fork":"cvra", "sparse":True}}
+    """
+    if isinstance(package, str):
+        return False
+
+    return bool(package[package_name_from_desc(package)].get("sparse", False))
+
+def sparse_clone(url, dest):
+    """
+    Git clones the given URL to the given destination path, checking out only
+    the package.yml file. The files the package actually uses are added by
+    sparse_checkout_update once its package.yml was read.
+    """
+    import subprocess
+
+    def fetch(path):
+        command = "git clone --no-checkout --filter=blob:none {url} {path}"
+        if subprocess.call(command.format(url=url, path=path).split()) != 0:
+            return False
+
+        command = "git -C {path} config core.sparseCheckout true"
+        subprocess.call(command.format(path=path).split())
+        update_sparse_checkout_file(path, {})
+        return True
+
+    fetch_atomically(dest, fetch)
+
+def sparse_checkout_patterns(package):
+    """
+    Returns the sparse checkout patterns matching the package.yml file and
+    every file or directory listed by the package.
+
+    Listing the package directory itself (".") checks out everything, while
+    paths outside of the package are skipped as git cannot match them.
+    """
+    patterns = set(["/package.yml"])
+
+    for category in package:
+        if not is_package_category(category):
+            continue
+
+        for path in package[category]:
+            path = os.path.normpath(path).replace(os.sep, "/")
+
+            if path == ".":
+                patterns.add("/*")
+                continue
+
+            if path == ".." or path.startswith("../") or os.path.isabs(path):
+                continue
+
+            pattern = "/" + path
+            if category.startswith("include_directories"):
+                pattern += "/"
+            patterns.add(pattern)
+
+    return sorted(patterns)
+
+def sparse_checkout_update(path, package):
+    """
+    Restricts the checkout of the sparse dependency at path to the files used
+    by its package description. This widens (or narrows) the checkout when the
+    package.yml changed, and is a no-op otherwise.
+    """
+    with dependency_lock(path):
+        update_sparse_checkout_file(path, package)
+
+def update_sparse_checkout_file(path, package):
+    """
+    Writes the sparse checkout patterns of package for the repository at path
+    and updates its working tree if they changed.
+    """
+    import subprocess
+
+    content = "".join(p + "\n" for p in sparse_checkout_patterns(package))
+    sparse_file = os.path.join(path, ".git", "info", "sparse-checkout")
+
+    if write_file_if_changed(sparse_file, content):
+        subprocess.call("git -C {path} read-tree -mu HEAD".format(path=path).split())
 
 def pkgfile_for_package(package, filemap=None):
     """
@@ -89,12 +256,63 @@ def pkgfile_for_package(package, filemap=None):
     """
     return os.path.join(path_for_package(package, filemap), "package.yml")
 
+def file_stamp(path):
+    """
+    Returns a value which changes when the file at path is modified, or None
+    if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_mtime_ns, stat.st_size]
+
+# Parsed package files, with the stamp of the file when it was parsed, kept
+# by long running processes only (see enable_package_cache).
+_package_cache = None
+
+def enable_package_cache():
+    """
+    Keeps the parsed package files in memory, so that a long running process
+    such as the daemon does not parse them again until they change.
+    """
+    global _package_cache
+
+    if _package_cache is None:
+        _package_cache = dict()
+
 def open_package(package, filemap=None):
     """
     Load a package given its description / name.
     """
+    import yaml
+
     pkgfile = pkgfile_for_package(package, filemap)
-    return yaml.load(open(pkgfile).read(), Loader=yaml.SafeLoader)
+
+    if _package_cache is None:
+        return yaml.load(open(pkgfile).read(), Loader=yaml.SafeLoader)
+
+    stamp = file_stamp(pkgfile)
+    cached = _package_cache.get(pkgfile)
+
+    if stamp is not None and cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    result = yaml.load(open(pkgfile).read(), Loader=yaml.SafeLoader)
+
+    if stamp is not None:
+        _package_cache[pkgfile] = (stamp, result)
+
+    return result
+
+def load_package_file(path="package.yml"):
+    """
+    Loads the top-level package file.
+    """
+    import yaml
+
+    return yaml.load(open(path).read(), Loader=yaml.SafeLoader)
 
 def download_dependencies(package, method, filemap=None):
     """
@@ -105,175 +323,1597 @@ def download_dependencies(package, method, filemap=None):
 
     filemap is a dictionnary mapping modules name to folders.
     """
-    # Skip everything if we dont have deps
-    if "depends" not in package:
-        return
+    # Dependencies left to visit. Only their descriptions are kept, not the
+    # package files which listed them.
+    pending = list(reversed(package.get("depends", [])))
+    visited = set()
 
-    for dep in package["depends"]:
+    while pending:
+        dep = pending.pop()
         repo_url = url_for_package(dep)
         repo_path = path_for_package(dep, filemap)
 
+        if repo_path in visited:
+            continue
+        visited.add(repo_path)
+
+        sparse = is_sparse(dep)
+
         if not os.path.exists(repo_path):
-            method(repo_url, repo_path)
+            if sparse:
+                sparse_clone(repo_url, repo_path)
+            else:
+                method(repo_url, repo_path)
 
         try:
             dep = open_package(dep, filemap)
         except IOError:
             continue
 
-        download_dependencies(dep, method=method, filemap=filemap)
+        if sparse:
+            sparse_checkout_update(repo_path, dep)
 
-def generate_source_list(package, category, filemap=None):
+        pending += reversed(dep.get("depends", []))
+
+def list_dependencies(package, filemap=None):
     """
-    Recursively generates a list of all source files needed to build a package.
-    The category parameter can be "source", "tests", etc.
+    Returns a list of (description, path) tuples for every downloaded
+    dependency of package, recursively. Each dependency appears only once.
     """
+    result = list()
+    visited = set()
 
-    def generate_source_set(package, category, filemap, basedir):
-        if category in package:
-            sources = set([os.path.join(basedir, i) for i in package[category]])
-        else:
-            sources = set()
+    def visit(package):
+        for dep in package.get("depends", []):
+            repo_path = path_for_package(dep, filemap)
 
-        if "depends" not in package:
-            return sources
+            if repo_path in visited or not os.path.exists(repo_path):
+                continue
 
-        for dep in package["depends"]:
-            pkg_dir = path_for_package(dep, filemap)
+            visited.add(repo_path)
+            result.append((dep, repo_path))
 
-            # Tries to open the dependency package.yml file.
-            # If it doesn't exist, simply proceed to next dependency
             try:
-                dep = open_package(dep, filemap)
+                visit(open_package(dep, filemap))
             except IOError:
                 continue
 
-            dep_src = generate_source_set(dep, category, filemap, pkg_dir)
-            sources = sources.union(dep_src)
+    visit(package)
+    return result
 
-        return sources
+def git_dir(path):
+    """
+    Returns the git directory of the repository at path, following the .git
+    file used by submodules.
+    """
+    dotgit = os.path.join(path, ".git")
 
-    source_list = list(generate_source_set(package, category, filemap, basedir='./'))
+    if os.path.isfile(dotgit):
+        with open(dotgit) as f:
+            content = f.read().strip()
+        if content.startswith("gitdir:"):
+            return os.path.join(path, content[len("gitdir:"):].strip())
 
-    return sorted(source_list)
+    return dotgit
 
-# Just needed to have a Python implementation of list because lists are not
-# dynamic enough in CPython
-class ListWrapper(list):
-    pass
+def read_git_head(path):
+    """
+    Returns the (branch, commit) checked out in the repository at path, by
+    reading git metadata directly. The branch is None on a detached HEAD.
+    """
+    directory = git_dir(path)
 
-def generate_source_dict(package, filemap=None):
+    with open(os.path.join(directory, "HEAD")) as f:
+        head = f.read().strip()
+
+    if not head.startswith("ref: "):
+        return None, head
+
+    ref = head[len("ref: "):]
+    branch = ref[len("refs/heads/"):] if ref.startswith("refs/heads/") else ref
+
+    try:
+        with open(os.path.join(directory, ref)) as f:
+            return branch, f.read().strip()
+    except IOError:
+        pass
+
+    # The ref might have been packed by git gc
+    try:
+        with open(os.path.join(directory, "packed-refs")) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return branch, fields[0]
+    except IOError:
+        pass
+
+    return branch, None
+
+def remote_head(url, branch):
     """
-    Generates a dictionary containing a list of files for each source category.
-    The result can then be used for template rendering for example.
+    Returns the commit of branch on the remote at url using git ls-remote, or
+    None if it cannot be found.
     """
-    result = dict()
+    import subprocess
 
-    for cat in ["source", "tests", "include_directories"]:
-        result[cat] = ListWrapper(generate_source_list(package, category=cat, filemap=filemap))
+    command = "git ls-remote {url} refs/heads/{branch}".format(url=url, branch=branch)
 
-    # Append test directories
-    test_inc = generate_source_list(package, category="include_directories.test",
-                                    filemap=filemap)
-    setattr(result["include_directories"], "test", test_inc)
+    try:
+        output = subprocess.check_output(command.split(), stderr=subprocess.DEVNULL)
+    except subprocess.CalledProcessError:
+        return None
 
-    result['target'] = dict()
-    targets = [key for key in package.keys() if key.startswith("target.")]
+    fields = output.decode("ascii").split()
+    return fields[0] if fields else None
 
-    for tar in targets:
-        arch = tar.replace("target.", "")
-        result["target"][arch] = generate_source_list(package, category=tar, filemap=filemap)
+def is_behind(path, url, branch, local, remote):
+    """
+    Returns True if the local commit of the repository at path is an ancestor
+    of the remote one, which means it can be fast-forwarded to it. The remote
+    commit is fetched first if it is not known locally.
+    """
+    import subprocess
 
-    return result
+    def git(command):
+        return subprocess.call(["git", "-C", path] + command.split(),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
-def create_dependency_location_map(filemap):
+    if git("cat-file -e {}^{{commit}}".format(remote)) != 0:
+        with dependency_lock(path):
+            if git("fetch -q {} {}".format(url, branch)) != 0:
+                return False
+
+    return git("merge-base --is-ancestor {} {}".format(local, remote)) == 0
+
+def find_outdated_dependencies(package, filemap=None, jobs=8, skipped=None):
     """
-    This function receives a dependency map in the following format:
-    {'control':['pid', 'odometry'], 'foo':['bar']} and converts it to the
-    following format : {'pid':'control', 'odometry':'control', 'bar':'foo'}. It
-    also sets a sensible default value.
+    Compares every dependency with its remote, querying the remotes
+    concurrently. Returns a list of (description, path, branch, local commit,
+    remote commit) tuples for the dependencies which are behind their remote.
+
+    Dependencies on a detached HEAD (for example pinned by freezer.py) are
+    skipped, as are the ones with local commits missing from the remote, which
+    cannot be fast-forwarded. Dependencies which are not git repositories (for
+    example vendored copies) are skipped too, and appended to the skipped list
+    as (description, path) tuples if one is given.
     """
-    locations = defaultdict(lambda: DEPENDENCIES_DIR)
+    from concurrent.futures import ThreadPoolExecutor
 
-    for destination, packages in filemap.items():
-        for p in packages:
-            locations[p] = destination
+    def check(dependency):
+        dep, path = dependency
 
-    return locations
+        try:
+            branch, local = read_git_head(path)
+        except IOError:
+            if skipped is not None:
+                skipped.append(dependency)
+            return None
 
+        if branch is None or local is None:
+            return None
 
-def create_jinja_env():
+        url = url_for_package(dep)
+        remote = remote_head(url, branch)
+
+        if remote is None or remote == local:
+            return None
+
+        if not is_behind(path, url, branch, local, remote):
+            return None
+
+        return dep, path, branch, local, remote
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(check, list_dependencies(package, filemap))
+        return [r for r in results if r is not None]
+
+def update_dependencies(package, filemap=None, jobs=8, skipped=None):
     """
-    Factory for a jinja2 environment with the correct paths for the packager.
+    Fetches and fast-forwards the dependencies which are behind their remote,
+    leaving the other ones untouched. Returns the lists of updated and failed
+    dependencies, with the entries of find_outdated_dependencies, which fills
+    skipped.
     """
-    template_dir = list()
-    template_dir.append(os.getcwd())
-    template_dir.append(os.path.dirname(__file__))
-    loader = jinja2.FileSystemLoader(template_dir)
-    return jinja2.Environment(loader=loader)
+    import subprocess
+    from concurrent.futures import ThreadPoolExecutor
 
+    def update(outdated):
+        dep, path, branch, _, _ = outdated
+        command = "git -C {path} pull --ff-only {url} {branch}"
+        command = command.format(path=path, url=url_for_package(dep), branch=branch)
+        with dependency_lock(path):
+            return subprocess.call(command.split()) == 0
 
-def render_template_to_file(template_name, dest_path, context):
+    outdated = find_outdated_dependencies(package, filemap, jobs, skipped)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(update, outdated))
+
+    updated = [dep for dep, success in zip(outdated, results) if success]
+    failed = [dep for dep, success in zip(outdated, results) if not success]
+
+    return updated, failed
+
+def open_bundle(path, mode):
     """
-    Renders the template given by name to dest_path using the given context.
+    Opens the dependency bundle at path as a tar stream, for reading ("r") or
+    writing ("w"). "-" stands for the standard input or output.
+
+    Bundles are compressed according to the extension of path when written
+    (.gz, .tgz, .bz2 or .xz) and the compression is detected when read.
     """
-    env = create_jinja_env()
-    template = env.get_template(template_name)
-    rendered = template.render(context)
+    import tarfile
 
-    try:
-        need_render = (open(dest_path, "r").read() != rendered)
-    except IOError:
-        need_render = True
+    if mode == "r":
+        mode = "r|*"
+        fileobj = sys.stdin.buffer if path == "-" else None
+    else:
+        compression = {".gz": "gz", ".tgz": "gz", ".bz2": "bz2", ".xz": "xz"}
+        mode = "w|" + compression.get(os.path.splitext(path)[1], "")
+        fileobj = sys.stdout.buffer if path == "-" else None
 
-    if need_render:
-        with open(dest_path, "w") as output:
-            output.write(rendered)
+    if fileobj is not None:
+        path = None
 
+    return tarfile.open(path, mode, fileobj=fileobj)
 
-def parse_args(args=None):
+def bundle_dependencies(package, bundle_path, filemap=None):
     """
-    Parses the commandline arguments.
+    Writes every downloaded dependency of package, along with its git history,
+    to a single tar archive, so that CI machines without network access can
+    restore them with unbundle_dependencies.
+
+    The archive starts with a manifest listing the path, URL, branch and
+    commit of each dependency, followed by the content of their directories
+    one after the other. Returns the manifest.
     """
-    description = "Download package dependencies and creates build files."
-    parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('--submodules', dest='download_method', action='store_const', const=submodule_add, default=clone)
+    import io
+    import json
+    import tarfile
 
-    return parser.parse_args(args=args)
+    dependencies = list()
 
-def main():
+    for dep, path in list_dependencies(package, filemap):
+        try:
+            branch, commit = read_git_head(path)
+        except IOError:
+            branch, commit = None, None
+
+        dependencies.append({
+            'name': package_name_from_desc(dep),
+            'path': os.path.normpath(path).replace(os.sep, "/"),
+            'url': url_for_package(dep),
+            'branch': branch,
+            'commit': commit,
+        })
+
+    manifest = {'dependencies': dependencies}
+    data = json.dumps(manifest, indent=2, sort_keys=True).encode()
+
+    with open_bundle(bundle_path, "w") as bundle:
+        info = tarfile.TarInfo(BUNDLE_MANIFEST)
+        info.size = len(data)
+        bundle.addfile(info, io.BytesIO(data))
+
+        for dep in dependencies:
+            bundle.add(dep['path'])
+
+    return manifest
+
+def bundle_member_dependency(member, paths):
     """
-    Main function of the application.
+    Returns the dependency path of paths which contains the given archive
+    member. Raises ValueError if the member would be written outside of the
+    dependencies, or is a link pointing outside of its dependency.
     """
-    args = parse_args()
+    import posixpath
 
-    try:
-        package = yaml.load(open("package.yml").read(), Loader=yaml.SafeLoader)
-    except FileNotFoundError:
-        print('package.yml was not found. Did you forget to git add it ?')
-        return
+    name = posixpath.normpath(member.name)
 
-    # fixme: this redefines the constant DEPENDENCIES_DIR if dependency-dir is set for the top-level package.yml
-    if 'dependency-dir' in package:
-        dep = package['dependency-dir']
+    if posixpath.isabs(name) or ".." in name.split("/"):
+        raise ValueError("Unsafe path in bundle: {}".format(member.name))
+
+    containing = [p for p in paths if name == p or name.startswith(p + "/")]
+
+    if not containing:
+        raise ValueError("{} is not part of a bundled dependency".format(member.name))
+
+    path = max(containing, key=len)
+
+    if member.issym():
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name), member.linkname))
+    elif member.islnk():
+        target = posixpath.normpath(member.linkname)
+    elif member.isfile() or member.isdir():
+        return path
     else:
-        dep = DEPENDENCIES_DIR
+        raise ValueError("Unsupported file type in bundle: {}".format(member.name))
 
-    filemap = defaultdict(lambda: dep)
+    if posixpath.isabs(member.linkname) or not (target == path or target.startswith(path + "/")):
+        raise ValueError("Link pointing outside of its dependency: {}".format(member.name))
 
-    download_dependencies(package, method=args.download_method, filemap=filemap)
-    context = generate_source_dict(package, filemap)
+    return path
 
-    context['include_directories'].append(dep)
+def unbundle_dependencies(bundle_path):
+    """
+    Restores the dependencies from a bundle written by bundle_dependencies, in
+    a single sequential pass over the archive, which can therefore be read
+    from a pipe.
 
-    render_cmakelists_for_tests = package.get("render_cmakelists_for_tests", True)
+    As with clones, each dependency is extracted next to its final location
+    and renamed once complete. Dependencies which already exist are left
+    untouched. Returns the manifest of the bundle.
+    """
+    import json
+    import posixpath
+    import shutil
+    import tarfile
 
-    if context["tests"] and render_cmakelists_for_tests:
-        render_template_to_file("CMakeLists.txt.jinja", "CMakeLists.txt", context)
+    # Python versions with extraction filters also check the paths themselves
+    options = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
 
-    if "templates" in package:
-        for template, dest in package["templates"].items():
-            render_template_to_file(template, dest, context)
+    def start(path):
+        if os.path.exists(path):
+            return path, None
+
+        directory, name = os.path.split(os.path.normpath(path))
+        tmp = os.path.join(directory, ".{}.tmp-{}".format(name, os.getpid()))
+        shutil.rmtree(tmp, ignore_errors=True)
+        return path, tmp
+
+    def finish(current):
+        path, tmp = current
+
+        if tmp is None:
+            return
+
+        try:
+            with dependency_lock(path):
+                if os.path.exists(tmp) and not os.path.exists(path):
+                    os.rename(tmp, path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    with open_bundle(bundle_path, "r") as bundle:
+        first = bundle.next()
+
+        if first is None or first.name != BUNDLE_MANIFEST:
+            raise ValueError("{} is not a dependency bundle".format(bundle_path))
+
+        manifest = json.loads(bundle.extractfile(first).read().decode())
+        paths = [dep['path'] for dep in manifest['dependencies']]
+        current = None
+
+        try:
+            for member in iter(bundle.next, None):
+                path = bundle_member_dependency(member, paths)
+
+                # Members of a dependency are contiguous in the archive
+                if current is None or current[0] != path:
+                    if current is not None:
+                        finish(current)
+                    current = start(path)
+
+                tmp = current[1]
+                if tmp is None:
+                    continue
+
+                member.name = tmp + posixpath.normpath(member.name)[len(path):]
+                if member.islnk():
+                    member.linkname = tmp + posixpath.normpath(member.linkname)[len(path):]
+
+                bundle.extract(member, **options)
+        except BaseException:
+            if current is not None and current[1] is not None:
+                shutil.rmtree(current[1], ignore_errors=True)
+            raise
+
+        if current is not None:
+            finish(current)
+
+    return manifest
+
+def is_glob(pattern):
+    """
+    Returns True if the given file entry is a glob pattern.
+    """
+    return any(c in pattern for c in '*?[')
+
+def glob_to_regex(pattern):
+    """
+    Translates a glob pattern to a regular expression matching paths separated
+    by slashes. "*" and "?" do not match slashes, while "**" matches any number
+    of directories.
+    """
+    import re
+
+    result = ''
+    i = 0
+
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            result += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            result += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            result += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            result += re.escape(pattern[i])
+            i += 1
+
+    return re.compile(result + r'\Z')
+
+# Files found under a directory, along with the mtime of every directory which
+# was scanned to find them. Adding or removing a file changes the mtime of its
+# directory, so the walk only has to be done again when one of them changed.
+_directory_cache = dict()
+
+def directory_stamp(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def scanned_directories():
+    """
+    Returns the directories which were scanned to expand glob patterns.
+    """
+    return [d for stamps, _ in _directory_cache.values() for d in stamps]
+
+def list_directory_files(root):
+    """
+    Returns the paths, relative to root and separated by slashes, of all files
+    under root. Hidden entries, nested packages (directories with their own
+    package.yml) and the build and dependencies directories are skipped.
+    """
+    skipped = [os.path.normpath(BUILD_DIR), os.path.normpath(DEPENDENCIES_DIR)]
+
+    cached = _directory_cache.get(root)
+
+    if cached is not None:
+        stamps, files = cached
+        if all(directory_stamp(d) == stamp for d, stamp in stamps.items()):
+            return files
+
+    stamps = dict()
+    files = list()
+    pending = ['']
+
+    while pending:
+        reldir = pending.pop()
+        path = os.path.join(root, reldir)
+
+        try:
+            stamps[path] = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except OSError:
+            continue
+
+        if reldir and any(e.name == 'package.yml' for e in entries):
+            continue
+
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+
+            relpath = reldir + '/' + entry.name if reldir else entry.name
+
+            if entry.is_dir(follow_symlinks=False):
+                # Paths are compared relative to the current directory
+                if os.path.normpath(os.path.join(root, relpath)) not in skipped:
+                    pending.append(relpath)
+            else:
+                files.append(relpath)
+
+    files.sort()
+    _directory_cache[root] = (stamps, files)
+
+    return files
+
+def expand_globs(entries, basedir):
+    """
+    Expands the glob patterns in the given list of files, relative to basedir.
+    Entries which are not patterns are kept as is.
+
+    Only the directory part of a pattern before its first wildcard is scanned,
+    so "src/**/*.c" does not look outside of src.
+    """
+    result = list()
+
+    for entry in entries:
+        if not is_glob(entry):
+            result.append(entry)
+            continue
+
+        components = entry.split('/')
+        literal = list()
+        while len(components) > 1 and not is_glob(components[0]):
+            literal.append(components.pop(0))
+        prefix = ''.join(c + '/' for c in literal)
+
+        regex = glob_to_regex('/'.join(components))
+        files = list_directory_files(os.path.join(basedir, prefix))
+        result += [prefix + f for f in files if regex.match(f)]
+
+    return result
+
+def package_files(package, category, basedir):
+    """
+    Returns the entries of the given category of a package, relative to the
+    current directory. Glob patterns are expanded, except for include
+    directories.
+    """
+    entries = package.get(category, [])
+
+    if not category.startswith("include_directories"):
+        entries = expand_globs(entries, basedir)
+
+    return [os.path.join(basedir, i) for i in entries]
+
+def generate_source_list(package, category, filemap=None):
+    """
+    Recursively generates a list of all source files needed to build a package.
+    The category parameter can be "source", "tests", etc.
+    """
+
+    def generate_source_set(package, category, filemap, basedir):
+        if category in package:
+            sources = set(package_files(package, category, basedir))
+        else:
+            sources = set()
+
+        if "depends" not in package:
+            return sources
+
+        for dep in package["depends"]:
+            pkg_dir = path_for_package(dep, filemap)
+
+            # Tries to open the dependency package.yml file.
+            # If it doesn't exist, simply proceed to next dependency
+            try:
+                dep = open_package(dep, filemap)
+            except IOError:
+                continue
+
+            dep_src = generate_source_set(dep, category, filemap, pkg_dir)
+            sources = sources.union(dep_src)
+
+        return sources
+
+    source_list = list(generate_source_set(package, category, filemap, basedir='./'))
+
+    return sorted(source_list)
+
+# Just needed to have a Python implementation of list because lists are not
+# dynamic enough in CPython
+class ListWrapper(list):
+    pass
+
+class PackageNode:
+    """
+    Package of the resolved dependency graph (see resolve_package_graph).
+
+    The files of each category are stored once per package, as a tuple of
+    interned paths relative to the current directory. The lists of the
+    template context are built from those tuples, so each path is held in
+    memory only once, however many lists it appears in.
+    """
+    __slots__ = ('name', 'path', 'depends', 'files')
+
+    def __init__(self, name, path, depends, files):
+        self.name = name
+        self.path = path
+        self.depends = depends
+        self.files = files
+
+    def as_dict(self):
+        """
+        Returns the package list entry of this node (see generate_package_list),
+        which shares the tuples of the node rather than copying them.
+        """
+        node = {'name': self.name, 'path': self.path, 'depends': self.depends}
+
+        for cat in PACKAGE_CATEGORIES:
+            node[cat] = ()
+
+        node.update(self.files)
+
+        return node
+
+def resolve_package_graph(package, filemap=None):
+    """
+    Returns the dependency graph of package as a list of PackageNode, in the
+    order documented in generate_package_list. Each package is only visited
+    once, even with diamond dependencies.
+    """
+    result = list()
+    visited = set(['./'])
+
+    def create_node(package, name, basedir):
+        files = dict()
+        for cat in package:
+            if is_package_category(cat):
+                paths = package_files(package, cat, basedir)
+                files[sys.intern(cat)] = tuple(sorted(sys.intern(p) for p in paths))
+
+        node = PackageNode(name, sys.intern(basedir), list(), files)
+        return node, iter(list(package.get("depends", [])))
+
+    # Packages being visited, with their dependencies left to visit. Only the
+    # node built from a package file is kept, not the package file itself.
+    stack = [create_node(package, None, './')]
+
+    while stack:
+        node, dependencies = stack[-1]
+        dep = next(dependencies, None)
+
+        if dep is None:
+            stack.pop()
+            node.depends = tuple(node.depends)
+            result.append(node)
+            continue
+
+        pkg_dir = path_for_package(dep, filemap)
+
+        if pkg_dir not in visited:
+            try:
+                dep_package = open_package(dep, filemap)
+            except IOError:
+                continue
+
+            visited.add(pkg_dir)
+            stack.append(create_node(dep_package, package_name_from_desc(dep), pkg_dir))
+
+        node.depends.append(package_name_from_desc(dep))
+
+    result.reverse()
+
+    return result
+
+def merge_package_files(graph, category):
+    """
+    Returns the sorted files of the given category of every package in graph.
+    """
+    files = set()
+
+    for node in graph:
+        files.update(node.files.get(category, ()))
+
+    return sorted(files)
+
+def generate_source_dict(package, filemap=None):
+    """
+    Generates a dictionary containing a list of files for each source category.
+    The result can then be used for template rendering for example.
+    """
+    graph = resolve_package_graph(package, filemap)
+    result = dict()
+
+    for cat in ["source", "tests", "include_directories"]:
+        result[cat] = ListWrapper(merge_package_files(graph, cat))
+
+    # Append test directories
+    test_inc = merge_package_files(graph, "include_directories.test")
+    setattr(result["include_directories"], "test", test_inc)
+
+    result['target'] = dict()
+    targets = [key for key in package.keys() if key.startswith("target.")]
+
+    for tar in targets:
+        arch = tar.replace("target.", "")
+        result["target"][arch] = merge_package_files(graph, tar)
+
+    result['packages'] = [node.as_dict() for node in graph]
+    result['package_sources'] = package_sources(result['packages'])
+
+    return result
+
+def package_sources(packages):
+    """
+    Returns the name, path and sources of every package of a package list (see
+    generate_package_list). This is all the builtin build files read from the
+    package list, so they are not rendered again when tests are added.
+    """
+    return [{'name': pkg['name'], 'path': pkg['path'], 'source': pkg['source']}
+            for pkg in packages]
+
+def is_package_category(key):
+    """
+    Returns True if the given package.yml key holds a list of files or
+    directories, relative to the package.
+    """
+    return key in PACKAGE_CATEGORIES or key.startswith("target.")
+
+def generate_package_list(package, filemap=None):
+    """
+    Returns the list of packages in the dependency graph, each one with its own
+    files for every category, its name, path and direct dependencies.
+
+    The list is topologically ordered: the root package (whose name is None)
+    comes first and each package comes before its dependencies, which is the
+    order static libraries must be given to the linker. Each package appears
+    only once, even with diamond dependencies.
+    """
+    return [node.as_dict() for node in resolve_package_graph(package, filemap)]
+
+def unity_batches(sources, batch_size):
+    """
+    Splits a list of sources into batches of at most batch_size files written
+    in the same language. Returns a list of (extension, files) tuples.
+
+    Files which cannot be included in a unity source (assembly, headers, etc)
+    are returned as batches of their own, with a None extension.
+    """
+    cxx_extensions = ('.cpp', '.cc', '.cxx')
+    c_files = [f for f in sources if f.endswith('.c')]
+    cxx_files = [f for f in sources if f.endswith(cxx_extensions)]
+    other_files = [f for f in sources if not f.endswith(('.c',) + cxx_extensions)]
+    batches = list()
+
+    for ext, files in (('c', c_files), ('cpp', cxx_files)):
+        for i in range(0, len(files), batch_size):
+            batches.append((ext, files[i:i + batch_size]))
+
+    for f in other_files:
+        batches.append((None, [f]))
+
+    return batches
+
+def write_unity_batches(name, sources, batch_size, directory=UNITY_DIR):
+    """
+    Writes the unity sources batching the given sources in directory, using
+    name as a prefix. Returns the list of files to compile, which replaces the
+    original source list.
+    """
+    result = list()
+
+    for i, (ext, files) in enumerate(unity_batches(sources, batch_size)):
+        # Batches of a single file gain nothing from a wrapper
+        if ext is None or len(files) == 1:
+            result += files
+            continue
+
+        path = os.path.join(directory, '{}_{}.{}'.format(name, i, ext))
+        content = ''.join('#include "{}"\n'.format(os.path.relpath(f, directory))
+                          for f in files)
+        write_file_if_changed(path, content)
+        result.append(path)
+
+    return sorted(result)
+
+def unity_name(category, basedir):
+    """
+    Returns the prefix of unity sources for a category of the package in
+    basedir.
+    """
+    name = os.path.normpath(basedir).replace(os.sep, '_').strip('._') or 'package'
+    return '{}_{}'.format(category.replace('.', '_'), name)
+
+def generate_unity_dict(package, batch_size=UNITY_BATCH_SIZE, filemap=None,
+                        directory=UNITY_DIR, test_main=TEST_MAIN, packages=None):
+    """
+    Generates the unity sources of a package and returns a dictionary with the
+    same layout as generate_source_dict, listing the files to compile in a
+    unity build.
+
+    Test files named in test_main are never batched, so that test shards can
+    all include them. The package list of the dependency graph (see
+    generate_package_list) is resolved again unless it is given as packages.
+    """
+    if packages is None:
+        packages = generate_package_list(package, filemap)
+
+    unity_packages = list()
+
+    for pkg in packages:
+        unity_pkg = dict(pkg)
+
+        for cat in pkg:
+            if cat == "source" or cat == "tests" or cat.startswith("target."):
+                name = unity_name(cat, pkg['path'])
+                files = pkg[cat]
+                mains = [f for f in files if cat == "tests" and is_test_main(f, test_main)]
+                files = [f for f in files if f not in mains]
+                unity_pkg[cat] = tuple(sorted(write_unity_batches(name, files, batch_size, directory) + mains))
+
+        unity_packages.append(unity_pkg)
+
+    def merge(category):
+        return sorted(f for pkg in unity_packages for f in pkg.get(category, []))
+
+    result = dict()
+    result['packages'] = unity_packages
+    result['package_sources'] = package_sources(unity_packages)
+
+    for cat in ["source", "tests"]:
+        result[cat] = merge(cat)
+
+    result['target'] = dict()
+    targets = [key for key in package.keys() if key.startswith("target.")]
+
+    for tar in targets:
+        arch = tar.replace("target.", "")
+        result['target'][arch] = merge(tar)
+
+    return result
+
+def write_precompiled_header(headers, path=PRECOMPILED_HEADER):
+    """
+    Writes the header which is precompiled for C++ sources, including every
+    given header, and returns its path.
+
+    Headers between angle brackets (for example <CppUTest/TestHarness.h>) are
+    searched in the include directories, others are paths relative to the
+    top-level package.
+    """
+    directory = os.path.dirname(path)
+    content = ''
+
+    for header in headers:
+        if header.startswith('<'):
+            content += '#include {}\n'.format(header)
+        else:
+            content += '#include "{}"\n'.format(os.path.relpath(header, directory))
+
+    write_file_if_changed(path, content)
+
+    return path
+
+def is_test_main(path, test_main=TEST_MAIN):
+    """
+    Returns True if the given test file defines the main() of the test
+    executables, according to the test_main list of file names.
+    """
+    return os.path.basename(path) in test_main
+
+def generate_test_shards(packages, count, method="round-robin", test_main=TEST_MAIN):
+    """
+    Splits the tests of a package list (see generate_package_list) into at
+    most count shards, each one being built as its own test executable.
+
+    The "round-robin" method deals test files one by one to the shards, while
+    the "package" method keeps the tests of a package together, giving each
+    package to the shard with the fewest tests.
+
+    Files named in test_main define the entry point of the executables, so
+    they are not split but added to every shard.
+    """
+    shards = [list() for _ in range(count)]
+    mains = sorted(f for pkg in packages for f in pkg['tests'] if is_test_main(f, test_main))
+
+    def split(tests):
+        return [f for f in tests if not is_test_main(f, test_main)]
+
+    if method == "round-robin":
+        tests = sorted(f for pkg in packages for f in split(pkg['tests']))
+        for i, f in enumerate(tests):
+            shards[i % count].append(f)
+    elif method == "package":
+        groups = sorted((split(pkg['tests']) for pkg in packages if split(pkg['tests'])),
+                        key=len, reverse=True)
+        for tests in groups:
+            min(shards, key=len).extend(tests)
+    else:
+        raise ValueError("Unknown test sharding method: {}".format(method))
+
+    return [sorted(shard + mains) for shard in shards if shard]
+
+def create_dependency_location_map(filemap):
+    """
+    This function receives a dependency map in the following format:
+    {'control':['pid', 'odometry'], 'foo':['bar']} and converts it to the
+    following format : {'pid':'control', 'odometry':'control', 'bar':'foo'}. It
+    also sets a sensible default value.
+    """
+    locations = defaultdict(lambda: DEPENDENCIES_DIR)
+
+    for destination, packages in filemap.items():
+        for p in packages:
+            locations[p] = destination
+
+    return locations
+
+
+def object_path(source, builddir):
+    """
+    Returns the path of the object file compiled from source in builddir.
+
+    Parent directory references are mangled so that objects of sources living
+    outside of the package (for example in ../dependencies) still end up in
+    builddir.
+    """
+    source = os.path.normpath(source).lstrip(os.sep)
+    source = source.replace('..', '__')
+    return os.path.join(builddir, source + '.o')
+
+
+def is_compilable(path):
+    """
+    Returns True if the given file is compiled to an object, rather than being
+    a header or some other file listed alongside sources.
+    """
+    return path.endswith(COMPILED_EXTENSIONS)
+
+
+def static_libraries(packages):
+    """
+    Returns the dependencies from a package list (see generate_package_list)
+    which are built as static libraries, keeping the link order.
+    """
+    return [pkg for pkg in packages[1:] if any(is_compilable(f) for f in pkg['source'])]
+
+
+def template_search_path():
+    """
+    Returns the directories templates are loaded from, by order of priority.
+    """
+    return [os.getcwd(), os.path.dirname(__file__)]
+
+
+def create_jinja_env():
+    """
+    Factory for a jinja2 environment with the correct paths for the packager.
+    """
+    import jinja2
+
+    loader = jinja2.FileSystemLoader(template_search_path())
+    env = jinja2.Environment(loader=loader)
+    env.filters['object_path'] = object_path
+    env.filters['static_libraries'] = static_libraries
+    env.tests['compilable'] = is_compilable
+    env.globals['toolchain_prefix'] = TOOLCHAIN_PREFIXES
+    return env
+
+
+def template_context_paths(ast, names):
+    """
+    Returns the context values read by a parsed template, restricted to the
+    given variable names, as tuples of attribute names.
+
+    Attribute and constant item lookups are followed, so that reading
+    target.arm only depends on the arm target rather than on all of them.
+    Calling a method on a value (target.items()) depends on the whole value,
+    while testing it in a condition (unity if unity else ...) only depends on
+    its truth, recorded as a final "?" name.
+    """
+    import jinja2
+
+    paths = set()
+
+    def lookup_path(node):
+        if isinstance(node, jinja2.nodes.Name):
+            return (node.name, )
+        if isinstance(node, jinja2.nodes.Getattr):
+            parent = lookup_path(node.node)
+            return parent + (node.attr, ) if parent else None
+        if isinstance(node, jinja2.nodes.Getitem) and isinstance(node.arg, jinja2.nodes.Const):
+            parent = lookup_path(node.node)
+            return parent + (str(node.arg.value), ) if parent else None
+        return None
+
+    def visit(node, called=False, tested=False):
+        path = lookup_path(node)
+
+        if path is not None:
+            if path[0] in names:
+                if called and len(path) > 1:
+                    path = path[:-1]
+                elif tested:
+                    path += ('?', )
+                paths.add(path)
+            return
+
+        for child in node.iter_child_nodes():
+            visit(child, isinstance(node, jinja2.nodes.Call) and child is node.node,
+                  isinstance(node, (jinja2.nodes.If, jinja2.nodes.CondExpr)) and child is node.test)
+
+    visit(ast)
+    return paths
+
+
+def resolve_context_path(context, path):
+    """
+    Returns the value found in context by following the attribute names of
+    path, or None if it does not exist. Names of constant subscripts of lists,
+    such as the 0 of packages[0], are used as indexes, and a "?" name gives the
+    truth of the value (see template_context_paths).
+    """
+    value = context
+
+    for name in path:
+        if name == '?':
+            value = bool(value)
+        elif isinstance(value, dict):
+            value = value.get(name)
+        elif isinstance(value, (list, tuple)):
+            try:
+                value = value[int(name)]
+            except (ValueError, IndexError):
+                value = getattr(value, name, None)
+        else:
+            value = getattr(value, name, None)
+
+    return value
+
+
+def template_inputs(env, template_name):
+    """
+    Returns what the rendering of template_name depends on: the sources of the
+    template and of the templates it extends or includes, the files they were
+    loaded from, and the context paths they read.
+
+    Returns None if the inputs cannot be determined, for example when a
+    template includes another one whose name is computed at render time.
+    """
+    import jinja2.meta
+
+    sources = dict()
+    files = dict()
+    paths = set()
+    pending = [template_name]
+
+    while pending:
+        name = pending.pop()
+        if name in sources:
+            continue
+
+        sources[name], files[name], _ = env.loader.get_source(env, name)
+        ast = env.parse(sources[name])
+        paths |= template_context_paths(ast, jinja2.meta.find_undeclared_variables(ast))
+
+        for reference in jinja2.meta.find_referenced_templates(ast):
+            if reference is None:
+                return None
+            pending.append(reference)
+
+    return sources, files, sorted(paths)
+
+
+def inputs_digest(sources, paths, context):
+    """
+    Returns a digest of the template sources and of the context values found
+    at the given paths.
+    """
+    import hashlib
+    import json
+
+    values = [[list(path), resolve_context_path(context, path)] for path in paths]
+    inputs = [sorted(sources.items()), values, os.path.getmtime(__file__)]
+    inputs = json.dumps(inputs, sort_keys=True, default=str)
+
+    return hashlib.sha1(inputs.encode()).hexdigest()
+
+
+def find_template_file(name):
+    """
+    Returns the file the template with the given name is loaded from, or None.
+    """
+    for directory in template_search_path():
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return os.path.normpath(path)
+
+    return None
+
+
+def cached_inputs_digest(entry, context):
+    """
+    Returns the digest of the inputs recorded in a render cache entry, computed
+    without parsing the templates, so without loading jinja2 at all.
+
+    Returns None if the entry does not record its inputs, or if one of its
+    templates would now be loaded from another file.
+    """
+    if len(entry) < 5 or entry[3] is None:
+        return None
+
+    sources = dict()
+
+    for name, filename in entry[3].items():
+        if filename is None or find_template_file(name) != os.path.normpath(filename):
+            return None
+
+        with open(filename, encoding="utf-8") as f:
+            sources[name] = f.read()
+
+    return inputs_digest(sources, [tuple(path) for path in entry[4]], context)
+
+
+def load_render_cache():
+    """
+    Loads the digests of the inputs used for the last rendering of each
+    output file.
+    """
+    import json
+
+    try:
+        with open(RENDER_CACHE, "r") as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return dict()
+
+
+def render_template_to_file(template_name, dest_path, context):
+    """
+    Renders the template given by name to dest_path using the given context.
+
+    The template is only rendered if the context values it reads, its source
+    or the output file changed since the last rendering.
+    """
+    import json
+
+    cache = load_render_cache()
+    cached = cache.get(dest_path)
+
+    try:
+        output_mtime = os.stat(dest_path).st_mtime_ns
+    except OSError:
+        output_mtime = None
+
+    # The inputs recorded by the last rendering are checked first, as parsing
+    # the templates again is what takes most of the time
+    if cached is not None and cached[0] == template_name and cached[2] == output_mtime:
+        if cached[1] is not None and cached_inputs_digest(cached, context) == cached[1]:
+            return
+
+    env = create_jinja_env()
+    inputs = template_inputs(env, template_name)
+
+    if inputs is None:
+        digest, files, paths = None, None, None
+    else:
+        sources, files, paths = inputs
+        digest = inputs_digest(sources, paths, context)
+
+    if digest is not None and cached is not None and cached[:3] == [template_name, digest, output_mtime]:
+        return
+
+    template = env.get_template(template_name)
+    rendered = template.render(context)
+    write_file_if_changed(dest_path, rendered)
+
+    try:
+        output_mtime = os.stat(dest_path).st_mtime_ns
+    except OSError:
+        output_mtime = None
+
+    cache[dest_path] = [template_name, digest, output_mtime, files, paths]
+
+    with open(RENDER_CACHE, "w") as f:
+        f.write(json.dumps(cache, indent=2, sort_keys=True))
+
+
+def write_file_if_changed(dest_path, content):
+    """
+    Writes content to dest_path, unless the file already has this content.
+    This avoids triggering rebuilds when nothing changed.
+
+    Returns True if the file was written.
+    """
+    try:
+        with open(dest_path, "r") as current:
+            need_write = (current.read() != content)
+    except IOError:
+        need_write = True
+
+    if need_write:
+        directory = os.path.dirname(dest_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        with open(dest_path, "w") as output:
+            output.write(content)
+
+    return need_write
+
+
+def compile_command(source, prefix, includes, builddir, header=None):
+    """
+    Returns the compiler arguments for source, using the same flags as the
+    builtin ninja template. header is the precompiled header included in C++
+    sources, if any.
+    """
+    if source.endswith('.c'):
+        arguments = [prefix + 'gcc', '-Wall', '-g']
+    elif source.endswith(('.s', '.S')):
+        arguments = [prefix + 'gcc', '-x', 'assembler-with-cpp', '-Wall', '-g']
+    else:
+        arguments = [prefix + 'g++', '-Wall', '-g', '-std=c++14']
+
+    arguments += ['-I' + i for i in includes]
+
+    if header and source.endswith(('.cpp', '.cc', '.cxx')):
+        arguments += ['-include', header]
+
+    arguments += ['-c', source, '-o', object_path(source, builddir)]
+
+    return arguments
+
+
+def compile_commands(context, directory):
+    """
+    Yields the compilation database entries of the unit tests, if there are
+    any, and of every target of the context, one per compiled source. The unit
+    tests are built with the host compiler and the test include directories,
+    while targets use their own toolchain, as in the builtin ninja template.
+    """
+    includes = list(context['include_directories'])
+    target_headers = context.get('target_precompiled_header') or dict()
+    builds = list()
+
+    if context['tests']:
+        builds.append(('tests', '', includes + list(context['include_directories'].test),
+                       list(context['source']) + list(context['tests']),
+                       context.get('precompiled_header')))
+
+    for arch, files in sorted(context['target'].items()):
+        builds.append((arch, TOOLCHAIN_PREFIXES.get(arch, ''), includes,
+                       list(context['source']) + list(files), target_headers.get(arch)))
+
+    for name, prefix, build_includes, sources, header in builds:
+        builddir = os.path.join(NINJA_BUILD_DIR, name + '.dir')
+
+        for source in sources:
+            if is_compilable(source):
+                yield {
+                    'directory': directory,
+                    'file': source,
+                    'arguments': compile_command(source, prefix, build_includes,
+                                                 builddir, header),
+                }
+
+
+def write_compile_commands(context, dest_path=COMPILE_COMMANDS):
+    """
+    Writes the compilation database of the context to dest_path.
+
+    Entries are streamed to a temporary file which then replaces dest_path, so
+    tools never read a partial database. dest_path is left untouched when its
+    content did not change, so tools do not reload it needlessly.
+
+    Returns True if the file was written.
+    """
+    import filecmp
+    import json
+
+    tmp_path = "{}.tmp-{}".format(dest_path, os.getpid())
+
+    try:
+        with open(tmp_path, "w") as output:
+            output.write("[")
+            for i, entry in enumerate(compile_commands(context, os.getcwd())):
+                output.write(",\n" if i else "\n")
+                output.write(json.dumps(entry))
+            output.write("\n]\n")
+
+        if os.path.exists(dest_path) and filecmp.cmp(tmp_path, dest_path, shallow=False):
+            return False
+
+        os.replace(tmp_path, dest_path)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def parse_args(args=None):
+    """
+    Parses the commandline arguments.
+    """
+    import argparse
+
+    description = "Download package dependencies and creates build files."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--submodules', dest='download_method', action='store_const', const=submodule_add, default=clone)
+
+    subparsers = parser.add_subparsers(dest='command')
+
+    outdated = subparsers.add_parser('outdated', help='List dependencies behind their remote.')
+    update = subparsers.add_parser('update', help='Fast-forward dependencies behind their remote.')
+    subparsers.add_parser('daemon', help='Keep the dependency graph in memory and answer requests on {}.'.format(DAEMON_SOCKET))
+
+    bundle = subparsers.add_parser('bundle', help='Write all dependencies to a single archive.')
+    bundle.add_argument('file', nargs='?', default='dependencies.tar.gz',
+                        help='Path of the bundle, or - for the standard output (default: dependencies.tar.gz)')
+
+    unbundle = subparsers.add_parser('unbundle', help='Restore the dependencies from a bundle.')
+    unbundle.add_argument('file', help='Path of the bundle, or - for the standard input')
+
+    build = subparsers.add_parser('build', help='Render the build files then build the unit tests and every target concurrently.')
+    build.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                       help='Number of compilations run at once, for all builds (default: number of CPUs)')
+
+    for subparser in (outdated, update):
+        subparser.add_argument('-j', '--jobs', type=int, default=8,
+                               help='Number of remotes queried concurrently (default: 8)')
+
+    return parser.parse_args(args=args)
+
+def create_filemap(package):
+    """
+    Returns the dependency location map used for the given top-level package,
+    which might use its own dependency-dir.
+    """
+    # fixme: this redefines the constant DEPENDENCIES_DIR if dependency-dir is set for the top-level package.yml
+    dep = package.get('dependency-dir', DEPENDENCIES_DIR)
+    return defaultdict(lambda: dep)
+
+def generate_context(package, filemap, download_method=clone):
+    """
+    Downloads the dependencies of the top-level package then returns the
+    context used to render its templates.
+    """
+    download_dependencies(package, method=download_method, filemap=filemap)
+    context = generate_source_dict(package, filemap)
+
+    context['include_directories'].append(filemap.default_factory())
+
+    test_main = package.get("test_main", TEST_MAIN)
+
+    if package.get("unity_build", False):
+        batch_size = package.get("unity_batch_size", UNITY_BATCH_SIZE)
+        context['unity'] = generate_unity_dict(package, batch_size, filemap,
+                                               test_main=test_main,
+                                               packages=context['packages'])
+
+    if "test_shards" in package:
+        count = package["test_shards"]
+        if isinstance(count, bool) or not isinstance(count, int) or count < 1:
+            raise ValueError("test_shards must be a positive integer, got {!r}".format(count))
+
+        packages = context['unity']['packages'] if 'unity' in context else context['packages']
+        method = package.get("test_sharding", "round-robin")
+        context['test_shards'] = generate_test_shards(packages, count, method, test_main)
+
+    if "compiler_launcher" in package:
+        context['compiler_launcher'] = package["compiler_launcher"]
+
+    # The precompiled header of the unit tests is never given to the targets,
+    # which can list their own in precompiled_headers.<arch>
+    if "precompiled_headers" in package:
+        context['precompiled_header'] = write_precompiled_header(package["precompiled_headers"])
+
+    target_headers = dict()
+
+    for key, headers in package.items():
+        if key.startswith("precompiled_headers."):
+            arch = key.replace("precompiled_headers.", "")
+            path = os.path.join(os.path.dirname(PRECOMPILED_HEADER), arch, "precompiled.hpp")
+            target_headers[arch] = write_precompiled_header(headers, path)
+
+    if target_headers:
+        context['target_precompiled_header'] = target_headers
+
+    return context
+
+def render_build_files(package, context):
+    """
+    Renders the builtin build files and the templates asked for by the
+    top-level package.
+    """
+    render_cmakelists_for_tests = package.get("render_cmakelists_for_tests", True)
+
+    if context["tests"] and render_cmakelists_for_tests:
+        render_template_to_file("CMakeLists.txt.jinja", "CMakeLists.txt", context)
+
+    if package.get("render_ninja", False):
+        render_template_to_file("build.ninja.jinja", "build.ninja", context)
+
+    if package.get("render_compile_commands", False):
+        write_compile_commands(context)
+
+    if "templates" in package:
+        for template, dest in package["templates"].items():
+            render_template_to_file(template, dest, context)
+
+def build_jobs(package, context, max_jobs=1):
+    """
+    Returns the builds of the package, which can run concurrently, as a list of
+    (name, commands) tuples. Each command is an (arguments, working directory)
+    tuple, and the commands of a build run one after the other.
+
+    The unit tests are built with CMake in the build directory, configured
+    first if needed. Every Makefile rendered from templates is a build of its
+    own, named after its architecture for Makefile.<arch>.jinja, as is the
+    ninja build. As ninja does not use the make jobserver, it is given an even
+    share of max_jobs through its -j option.
+    """
+    jobs = list()
+
+    if context["tests"] and package.get("render_cmakelists_for_tests", True):
+        commands = list()
+        if not os.path.exists(os.path.join(BUILD_DIR, "CMakeCache.txt")):
+            commands.append((["cmake", ".."], BUILD_DIR))
+        commands.append((["make"], BUILD_DIR))
+        jobs.append(("tests", commands))
+
+    for template, dest in sorted(package.get("templates", {}).items()):
+        if not os.path.basename(dest).startswith("Makefile"):
+            continue
+
+        parts = template.split(".")
+        name = parts[1] if len(parts) == 3 and parts[0] == "Makefile" else dest
+        jobs.append((name, [(["make", "-f", dest], ".")]))
+
+    if package.get("render_ninja", False):
+        share = max(1, max_jobs // (len(jobs) + 1))
+        jobs.append(("ninja", [(["ninja", "-j", str(share)], ".")]))
+
+    return jobs
+
+def explicit_job_count(commands):
+    """
+    Returns the number of jobs given with a -j option to the commands of a
+    build, or None if they use the make jobserver instead.
+    """
+    counts = [int(arguments[arguments.index("-j") + 1])
+              for arguments, _ in commands if "-j" in arguments]
+    return max(counts) if counts else None
+
+def create_jobserver(slots):
+    """
+    Creates a GNU make jobserver with the given number of job slots, and
+    returns the file descriptors of its pipe as a (read, write) tuple.
+    """
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"+" * slots)
+    return read_fd, write_fd
+
+def run_builds(jobs, max_jobs):
+    """
+    Runs the given builds (see build_jobs) concurrently, sharing a make
+    jobserver so that at most max_jobs compilations run at once, in total.
+    Builds given an explicit -j option (see explicit_job_count) do not join
+    the jobserver, their jobs are taken out of its slots instead.
+    Returns a list of (name, success, duration in seconds, output) tuples,
+    in the order of jobs.
+    """
+    import subprocess
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    counts = [explicit_job_count(commands) for _, commands in jobs]
+    reserved = sum(count for count in counts if count is not None)
+    jobserver_builds = counts.count(None)
+
+    # Each make already has an implicit job slot of its own
+    read_fd, write_fd = create_jobserver(max(0, max_jobs - reserved - jobserver_builds))
+
+    env = dict(os.environ)
+    env.pop("MAKEFLAGS", None)
+    jobserver_env = dict(env)
+    jobserver_env["MAKEFLAGS"] = "-j{} --jobserver-fds={r},{w} --jobserver-auth={r},{w}".format(
+        max_jobs, r=read_fd, w=write_fd)
+
+    def run(job):
+        name, commands = job
+        start = time.monotonic()
+        output = b""
+        success = True
+        uses_jobserver = explicit_job_count(commands) is None
+
+        for arguments, cwd in commands:
+            os.makedirs(cwd, exist_ok=True)
+
+            try:
+                process = subprocess.Popen(arguments, cwd=cwd,
+                                           env=jobserver_env if uses_jobserver else env,
+                                           pass_fds=(read_fd, write_fd) if uses_jobserver else (),
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+            except OSError as e:
+                output += "{}: {}\n".format(arguments[0], e).encode()
+                success = False
+                break
+
+            output += process.communicate()[0]
+
+            if process.returncode != 0:
+                success = False
+                break
+
+        duration = time.monotonic() - start
+        return name, success, duration, output.decode(errors="replace")
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+            return list(executor.map(run, jobs))
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+def main():
+    """
+    Main function of the application.
+    """
+    args = parse_args()
+
+    if args.command == 'daemon':
+        from .daemon import serve
+        serve()
+        return
+
+    if args.command is None and os.path.exists(DAEMON_SOCKET):
+        from .daemon import request
+
+        # Falls back to rendering ourselves if the daemon is not running or
+        # could not render
+        try:
+            request('render', submodules=args.download_method is submodule_add)
+            return
+        except (OSError, RuntimeError):
+            pass
+
+    if args.command == 'unbundle':
+        manifest = unbundle_dependencies(args.file)
+        for dep in manifest['dependencies']:
+            print("{}: {}".format(dep['path'], (dep['commit'] or '')[:8]))
+        return
+
+    try:
+        package = load_package_file()
+    except FileNotFoundError:
+        print('package.yml was not found. Did you forget to git add it ?')
+        return
+
+    filemap = create_filemap(package)
+
+    if args.command == 'bundle':
+        manifest = bundle_dependencies(package, args.file, filemap)
+        # The bundle itself might be written to the standard output
+        if args.file != '-':
+            for dep in manifest['dependencies']:
+                print("{}: {}".format(dep['path'], (dep['commit'] or '')[:8]))
+        return
+
+    if args.command in ('outdated', 'update'):
+        skipped = list()
+
+        if args.command == 'outdated':
+            outdated, failed = find_outdated_dependencies(package, filemap, args.jobs, skipped), []
+        else:
+            outdated, failed = update_dependencies(package, filemap, args.jobs, skipped)
+
+        for _, path in skipped:
+            print("{}: not a git repository, skipped".format(path))
+
+        for _, path, branch, local, remote in outdated:
+            print("{}: {} {} -> {}".format(path, branch, local[:8], remote[:8]))
+
+        for _, path, branch, local, remote in failed:
+            print("{}: {} {} -> {} FAILED".format(path, branch, local[:8], remote[:8]))
+
+        if failed:
+            sys.exit(1)
+        return
+
+    context = generate_context(package, filemap, args.download_method)
+    render_build_files(package, context)
+
+    if args.command == 'build':
+        results = run_builds(build_jobs(package, context, args.jobs), args.jobs)
+
+        for name, success, duration, output in results:
+            if not success:
+                print(output)
+            print("{}: {} in {:.1f}s".format(name, "OK" if success else "FAILED", duration))
+
+        if not all(success for _, success, _, _ in results):
+            sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -53,6 +53,10 @@ def dump_versions_to_file(path):
         return
 
     for directory in os.listdir(DEPENDENCIES_DIR):
+        # Skips the lock files and in-progress clones of the packager
+        if directory.startswith('.'):
+            continue
+
         with cd(os.path.join(DEPENDENCIES_DIR, directory)):
             git_sha = subprocess.check_output("git rev-parse HEAD".split())
             git_sha = git_sha.decode("ascii") # converts to str
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+Measures how long starting the packager takes, using python -X importtime.
+
+The packager runs on every build, so its startup time adds up. This script
+fails if importing it takes longer than the budget, or if it loads modules it
+only needs for some commands (YAML and template parsing, subprocesses, command
+line parsing).
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+LAZY_MODULES = ['yaml', 'jinja2', 'subprocess', 'argparse']
+
+
+def import_times(module):
+    """
+    Imports module in a new interpreter and returns the cumulative import
+    time, in microseconds, of every module it loaded.
+    """
+    command = [sys.executable, '-X', 'importtime', '-c', 'import ' + module]
+    output = subprocess.run(command, stderr=subprocess.PIPE, check=True,
+                            universal_newlines=True).stderr
+
+    times = {}
+
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+
+    return times
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--module", default="cvra_packager.packager",
+                        help="Module to import (default: cvra_packager.packager).")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="Number of measurements (default: 10).")
+    parser.add_argument("--budget", type=float, default=25,
+                        help="Maximal median import time in milliseconds (default: 25).")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    runs = [import_times(args.module) for _ in range(args.runs)]
+
+    median = statistics.median(run[args.module] for run in runs) / 1000
+    loaded = [m for m in LAZY_MODULES if m in runs[0]]
+
+    print('{}: {:.1f} ms (median of {} runs, budget {:.1f} ms)'.format(
+        args.module, median, args.runs, args.budget))
+
+    failed = False
+
+    if median > args.budget:
+        print('Import time is over budget!')
+        failed = True
+
+    if loaded:
+        print('Modules which should be imported lazily: {}'.format(', '.join(loaded)))
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,13 @@ find yourself doing the same steps: building and running a test after each file
 change. It is also editor-independent, which is great :)
 """
 
-from cvra_packager import generate_source_dict
+from cvra_packager import create_filemap, generate_context
 import yaml
 import os.path
-from time import sleep
+from time import sleep, time, monotonic
 import subprocess
+import argparse
+import json
 
 try:
     from termcolor import cprint
@@ -22,34 +24,116 @@ except:
         print(msg)
 
 
-def run_tests(changed_path):
+def test_executables(context):
+    """
+    Returns the paths to the test executables built from the context, which
+    are several when the tests are sharded.
+    """
+    if "test_shards" not in context:
+        return ["build/tests"]
+
+    return ["build/tests_{}".format(i) for i in range(len(context['test_shards']))]
+
+def run_tests(changed_path, executables):
     """
     Run all the tests after a change in changed_path.
+
+    Returns the durations of the build and test steps, in seconds, along with
+    the result of the cycle.
     """
+    cycle = {'build': None, 'tests': None}
+
+    start = monotonic()
     failure = subprocess.call("make -C build/".split(), stdout=subprocess.DEVNULL)
+    cycle['build'] = monotonic() - start
 
     if failure:
         cprint('Build failed after {} changed!'.format(changed_path), 'red')
-        return
+        cycle['result'] = 'build failed'
+        return cycle
 
-    failure = subprocess.call("build/tests".split())
+    start = monotonic()
+
+    if len(executables) == 1:
+        failure = subprocess.call(executables)
+    else:
+        # Shards are independent, so run them concurrently and only show the
+        # output of the failing ones
+        processes = [subprocess.Popen([exe], stdout=subprocess.PIPE,
+                                      stderr=subprocess.STDOUT)
+                     for exe in executables]
+        failure = False
+
+        for process in processes:
+            output, _ = process.communicate()
+            if process.returncode:
+                print(output.decode(errors="replace"))
+                failure = True
+
+    cycle['tests'] = monotonic() - start
 
     if failure:
         cprint('Tests failed after {} changed!'.format(changed_path), 'red')
-        return
+        cycle['result'] = 'tests failed'
+        return cycle
 
     cprint('All OK', 'green')
+    cycle['result'] = 'ok'
+    return cycle
+
+METRICS = ['detection', 'build', 'tests', 'total']
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (nearest rank) of a non empty list of values.
+    """
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+def print_metrics(cycle, history):
+    """
+    Prints the durations of the last cycle and the percentiles of the cycles
+    in history.
+    """
+    def durations(cycle):
+        return ', '.join('{} {:.2f}s'.format(m, cycle[m])
+                         for m in METRICS if cycle[m] is not None)
+
+    print('Cycle: {}'.format(durations(cycle)))
+
+    stats = list()
+    for metric in METRICS:
+        values = [c[metric] for c in history if c[metric] is not None]
+        if values:
+            stats.append('{} {:.2f}/{:.2f}/{:.2f}s'.format(
+                metric, percentile(values, 50), percentile(values, 90), max(values)))
+
+    print('Last {} cycles (p50/p90/max): {}'.format(len(history), ', '.join(stats)))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Append the durations of every cycle to FILE, as JSON lines.")
+    parser.add_argument("--window", type=int, default=50,
+                        help="Number of cycles used for the percentiles (default: 50).")
+    return parser.parse_args()
 
 def main():
-    package = yaml.load(open("package.yml").read())
-    sources = generate_source_dict(package)
+    args = parse_args()
+    package = yaml.load(open("package.yml").read(), Loader=yaml.SafeLoader)
+    # The same context as the packager, so that the shards match the build
+    sources = generate_context(package, create_filemap(package))
 
     if len(sources['tests']) == 0:
         print('No unit tests ? Aborting !')
         return
 
+    executables = test_executables(sources)
+
     files = sources['tests'] + sources['source']
     modtimes = {}
+    history = []
 
     for path in files:
         modtimes[path] = os.path.getmtime(path)
@@ -65,7 +149,22 @@ def main():
 
             # If the file changed, run the build / tests
             if modtimes[path] != mtime:
-                run_tests(path)
+                # Time between the save and the moment it was noticed
+                detection = max(0, time() - mtime)
+
+                cycle = run_tests(path, executables)
+                cycle['detection'] = detection
+                cycle['total'] = detection + cycle['build'] + (cycle['tests'] or 0)
+                cycle['path'] = path
+                cycle['time'] = time()
+
+                history = (history + [cycle])[-args.window:]
+                print_metrics(cycle, history)
+
+                if args.metrics:
+                    with open(args.metrics, 'a') as f:
+                        f.write(json.dumps(cycle) + '\n')
+
                 modtimes[path] = mtime
 
         # Avoid full CPU usage
@@ -0,0 +1,30 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+
+class TemporaryDirectoryTestCase(unittest.TestCase):
+    """
+    Gives each test its own temporary directory, removed once it is done.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class WorkingDirectoryTestCase(TemporaryDirectoryTestCase):
+    """
+    Runs each test in a temporary working directory, for tests writing
+    dependency directories, lock files or build files.
+    """
+    def setUp(self):
+        super().setUp()
+        self.old_dir = os.getcwd()
+        os.chdir(self.directory)
+
+    def tearDown(self):
+        os.chdir(self.old_dir)
+        super().tearDown()
@@ -0,0 +1,119 @@
+import unittest
+import os
+import sys
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+from os.path import join
+
+
+class BuildJobsTestCase(WorkingDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.package = {'templates': {'Makefile.arm.jinja': 'Makefile.arm',
+                                      'Makefile.x86.jinja': 'Makefile',
+                                      'config.h.jinja': 'config.h'}}
+        self.context = {'tests': ['./pid_test.cpp']}
+
+    def test_tests_and_targets_are_built(self):
+        """
+        Checks that the unit tests and every rendered Makefile are built, but
+        not the other templates.
+        """
+        jobs = build_jobs(self.package, self.context)
+
+        self.assertEqual(['tests', 'arm', 'x86'], [name for name, _ in jobs])
+        self.assertEqual([(['make', '-f', 'Makefile.arm'], '.')], jobs[1][1])
+
+    def test_cmake_is_configured_once(self):
+        """
+        Checks that CMake is only configured when the build directory was not
+        configured yet.
+        """
+        jobs = dict(build_jobs(self.package, self.context))
+        self.assertEqual([['cmake', '..'], ['make']], [c for c, _ in jobs['tests']])
+
+        os.makedirs(BUILD_DIR)
+        open(join(BUILD_DIR, 'CMakeCache.txt'), 'w').close()
+
+        jobs = dict(build_jobs(self.package, self.context))
+        self.assertEqual([['make']], [c for c, _ in jobs['tests']])
+
+    def test_no_tests(self):
+        """
+        Checks that there is no test build without unit tests.
+        """
+        jobs = build_jobs(self.package, {'tests': []})
+        self.assertNotIn('tests', [name for name, _ in jobs])
+
+    def test_ninja(self):
+        """
+        Checks that the ninja build is run when it is rendered.
+        """
+        jobs = build_jobs({'render_ninja': True}, {'tests': []})
+        self.assertEqual([('ninja', [(['ninja', '-j', '1'], '.')])], jobs)
+
+    def test_ninja_gets_a_share_of_jobs(self):
+        """
+        Checks that ninja, which does not use the jobserver, is given an even
+        share of the jobs.
+        """
+        self.package['render_ninja'] = True
+        jobs = dict(build_jobs(self.package, self.context, 8))
+        self.assertEqual([(['ninja', '-j', '2'], '.')], jobs['ninja'])
+
+
+class RunBuildsTestCase(unittest.TestCase):
+    def python(self, code):
+        return ([sys.executable, '-c', code], '.')
+
+    def test_results(self):
+        """
+        Checks that each build reports its success and output, in order.
+        """
+        jobs = [('ok', [self.python('print("built")')]),
+                ('failed', [self.python('import sys; sys.exit(2)'),
+                            self.python('print("not run")')])]
+
+        results = run_builds(jobs, 2)
+
+        self.assertEqual(['ok', 'failed'], [r[0] for r in results])
+        self.assertEqual([True, False], [r[1] for r in results])
+        self.assertEqual('built\n', results[0][3])
+        self.assertEqual('', results[1][3])
+
+    def test_missing_program(self):
+        """
+        Checks that a missing build tool fails the build.
+        """
+        results = run_builds([('missing', [(['packager-missing-tool'], '.')])], 1)
+        self.assertFalse(results[0][1])
+
+    def test_jobserver_is_shared(self):
+        """
+        Checks that builds get the jobserver through MAKEFLAGS, with one job
+        slot less than the limit per build.
+        """
+        code = ('import os, re; '
+                'r = int(re.search(r"--jobserver-auth=(\\d+),", os.environ["MAKEFLAGS"]).group(1)); '
+                'print(len(os.read(r, 16)))')
+
+        results = run_builds([('a', [self.python(code)]), ('b', [self.python('pass')])], 5)
+
+        self.assertTrue(results[0][1])
+        self.assertEqual('3', results[0][3].strip())
+
+    def test_explicit_jobs_are_reserved(self):
+        """
+        Checks that the jobs of a build given an explicit -j option are taken
+        out of the jobserver, which this build does not get.
+        """
+        code = ('import os, re; '
+                'r = int(re.search(r"--jobserver-auth=(\\d+),", os.environ["MAKEFLAGS"]).group(1)); '
+                'print(len(os.read(r, 16)))')
+        ninja = ([sys.executable, '-c', 'import os; print("MAKEFLAGS" in os.environ)', '-j', '2'], '.')
+
+        results = run_builds([('a', [self.python(code)]), ('ninja', [ninja])], 5)
+
+        self.assertEqual('2', results[0][3].strip())
+        self.assertEqual('False', results[1][3].strip())
@@ -0,0 +1,129 @@
+import unittest
+import io
+import json
+import os
+import shutil
+import subprocess
+import tarfile
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+from os.path import join
+
+
+def git(*args):
+    identity = ['-c', 'user.name=packager', '-c', 'user.email=packager@example.com']
+    subprocess.check_call(['git'] + identity + list(args),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is required')
+class BundleTestCase(WorkingDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.package = {'depends': ['pid']}
+
+        for name, content in [('pid', 'depends: [math]\n'), ('math', 'source: [math.c]\n')]:
+            path = join('dependencies', name)
+            os.makedirs(path)
+            with open(join(path, 'package.yml'), 'w') as f:
+                f.write(content)
+            os.symlink('package.yml', join(path, 'link.yml'))
+            git('-C', path, 'init', '-q')
+            git('-C', path, 'add', '.')
+            git('-C', path, 'commit', '-q', '-m', 'initial')
+
+    def test_manifest_lists_every_dependency(self):
+        """
+        Checks that the manifest lists the dependencies found recursively,
+        with their checked out commit.
+        """
+        manifest = bundle_dependencies(self.package, 'deps.tar')
+
+        paths = [dep['path'] for dep in manifest['dependencies']]
+        self.assertEqual(['dependencies/pid', 'dependencies/math'], paths)
+        self.assertEqual(read_git_head(join('dependencies', 'pid'))[1],
+                         manifest['dependencies'][0]['commit'])
+
+    def test_restore(self):
+        """
+        Checks that unbundling restores the dependencies as git repositories.
+        """
+        bundle_dependencies(self.package, 'deps.tar.gz')
+        expected = read_git_head(join('dependencies', 'math'))
+        shutil.rmtree('dependencies')
+
+        unbundle_dependencies('deps.tar.gz')
+
+        self.assertEqual(expected, read_git_head(join('dependencies', 'math')))
+        self.assertTrue(os.path.islink(join('dependencies', 'math', 'link.yml')))
+        self.assertEqual(['math', 'pid'], sorted(f for f in os.listdir('dependencies')
+                                                 if not f.startswith('.')))
+
+    def test_existing_dependency_is_kept(self):
+        """
+        Checks that dependencies which are already there are not overwritten.
+        """
+        bundle_dependencies(self.package, 'deps.tar')
+        shutil.rmtree(join('dependencies', 'math'))
+
+        with open(join('dependencies', 'pid', 'package.yml'), 'w') as f:
+            f.write('local change\n')
+
+        unbundle_dependencies('deps.tar')
+
+        with open(join('dependencies', 'pid', 'package.yml')) as f:
+            self.assertEqual('local change\n', f.read())
+        self.assertTrue(os.path.exists(join('dependencies', 'math', 'package.yml')))
+
+
+class UnsafeBundleTestCase(WorkingDirectoryTestCase):
+    def write_bundle(self, *members):
+        """
+        Writes a bundle of the pid dependency with the given members.
+        """
+        manifest = json.dumps({'dependencies': [{'path': 'dependencies/pid'}]}).encode()
+
+        with tarfile.open('bundle.tar', 'w') as bundle:
+            info = tarfile.TarInfo(BUNDLE_MANIFEST)
+            info.size = len(manifest)
+            bundle.addfile(info, io.BytesIO(manifest))
+
+            for member in members:
+                bundle.addfile(member, io.BytesIO(b''))
+
+    def test_path_outside_of_dependencies(self):
+        """
+        Checks that members escaping the dependency directory are refused.
+        """
+        self.write_bundle(tarfile.TarInfo('dependencies/pid/../../evil'))
+
+        with self.assertRaises(ValueError):
+            unbundle_dependencies('bundle.tar')
+
+        self.assertFalse(os.path.exists('evil'))
+
+    def test_link_outside_of_dependency(self):
+        """
+        Checks that links pointing outside of their dependency are refused,
+        and that nothing is left behind.
+        """
+        link = tarfile.TarInfo('dependencies/pid/passwd')
+        link.type = tarfile.SYMTYPE
+        link.linkname = '../../../etc/passwd'
+        self.write_bundle(tarfile.TarInfo('dependencies/pid/pid.c'), link)
+
+        with self.assertRaises(ValueError):
+            unbundle_dependencies('bundle.tar')
+
+        self.assertEqual([], os.listdir('dependencies'))
+
+    def test_not_a_bundle(self):
+        """
+        Checks that archives without manifest are refused.
+        """
+        with tarfile.open('bundle.tar', 'w') as bundle:
+            bundle.addfile(tarfile.TarInfo('dependencies/pid/pid.c'), io.BytesIO(b''))
+
+        with self.assertRaises(ValueError):
+            unbundle_dependencies('bundle.tar')
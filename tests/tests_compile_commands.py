@@ -0,0 +1,131 @@
+import unittest
+import os
+import json
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+
+try:
+    from unittest.mock import *
+except ImportError:
+    # unittest.mock is only available in python >= 3.3
+    from mock import *
+
+
+def make_context():
+    include_directories = ListWrapper(['./include', 'dependencies'])
+    include_directories.test = ['./tests/mocks']
+
+    return {
+        'source': ['./pid.c', './pid.h'],
+        'tests': ['./tests/pid_test.cpp'],
+        'include_directories': include_directories,
+        'target': {'arm': ['./startup.s']},
+    }
+
+
+class CompileCommandsTestCase(unittest.TestCase):
+    def test_test_sources_use_test_includes(self):
+        """
+        Checks that unit test entries use the host compiler and test include
+        directories.
+        """
+        entries = list(compile_commands(make_context(), '/project'))
+        test_entry = entries[1]
+
+        self.assertEqual('./tests/pid_test.cpp', test_entry['file'])
+        self.assertEqual('/project', test_entry['directory'])
+        self.assertEqual(['g++', '-Wall', '-g', '-std=c++14',
+                          '-I./include', '-Idependencies', '-I./tests/mocks',
+                          '-c', './tests/pid_test.cpp',
+                          '-o', 'build/ninja/tests.dir/tests/pid_test.cpp.o'],
+                         test_entry['arguments'])
+
+    def test_targets_use_their_toolchain(self):
+        """
+        Checks that target entries use the toolchain of their architecture and
+        no test include directories.
+        """
+        entries = list(compile_commands(make_context(), '/project'))
+        arm_entries = entries[2:]
+
+        self.assertEqual(['./pid.c', './startup.s'], [e['file'] for e in arm_entries])
+        self.assertEqual(['arm-none-eabi-gcc', '-Wall', '-g', '-I./include',
+                          '-Idependencies', '-c', './pid.c',
+                          '-o', 'build/ninja/arm.dir/pid.c.o'],
+                         arm_entries[0]['arguments'])
+        self.assertEqual(['-x', 'assembler-with-cpp'], arm_entries[1]['arguments'][1:3])
+
+    def test_headers_are_skipped(self):
+        """
+        Checks that only compiled files get an entry.
+        """
+        files = [e['file'] for e in compile_commands(make_context(), '/project')]
+        self.assertNotIn('./pid.h', files)
+
+    def test_no_tests(self):
+        """
+        Checks that there is no unit test entry without unit tests.
+        """
+        context = make_context()
+        context['tests'] = []
+
+        entries = list(compile_commands(context, '/project'))
+
+        self.assertEqual(['./pid.c', './startup.s'], [e['file'] for e in entries])
+        self.assertTrue(all('/arm.dir/' in e['arguments'][-1] for e in entries))
+
+    def test_precompiled_headers_are_included(self):
+        """
+        Checks that C++ sources include the precompiled header of their build,
+        as in the ninja build.
+        """
+        context = make_context()
+        context['precompiled_header'] = 'build/pch/precompiled.hpp'
+        context['target']['arm'].append('./main.cpp')
+        context['target_precompiled_header'] = {'arm': 'build/pch/arm/precompiled.hpp'}
+
+        entries = list(compile_commands(context, '/project'))
+        arguments = dict(((e['file'], e['arguments'][0]), e['arguments']) for e in entries)
+
+        self.assertIn('-include build/pch/precompiled.hpp -c',
+                      ' '.join(arguments[('./tests/pid_test.cpp', 'g++')]))
+        self.assertIn('-include build/pch/arm/precompiled.hpp -c',
+                      ' '.join(arguments[('./main.cpp', 'arm-none-eabi-g++')]))
+        self.assertNotIn('-include', arguments[('./pid.c', 'gcc')])
+
+
+class WriteCompileCommandsTestCase(WorkingDirectoryTestCase):
+    def test_writes_valid_json(self):
+        """
+        Checks that the streamed file is a valid compilation database.
+        """
+        self.assertTrue(write_compile_commands(make_context()))
+
+        with open(COMPILE_COMMANDS) as f:
+            entries = json.load(f)
+
+        self.assertEqual(4, len(entries))
+        self.assertEqual(os.getcwd(), entries[0]['directory'])
+        self.assertEqual(['compile_commands.json'], os.listdir('.'))
+
+    def test_empty_context(self):
+        """
+        Checks that a context without sources gives an empty database.
+        """
+        context = make_context()
+        context['source'], context['tests'], context['target'] = [], [], {}
+        write_compile_commands(context)
+
+        with open(COMPILE_COMMANDS) as f:
+            self.assertEqual([], json.load(f))
+
+    def test_unchanged_file_is_not_replaced(self):
+        """
+        Checks that the database is not replaced when it did not change.
+        """
+        write_compile_commands(make_context())
+        os.utime(COMPILE_COMMANDS, ns=(0, 0))
+
+        self.assertFalse(write_compile_commands(make_context()))
+        self.assertEqual(0, os.stat(COMPILE_COMMANDS).st_mtime_ns)
+        self.assertEqual(['compile_commands.json'], os.listdir('.'))
@@ -0,0 +1,112 @@
+import unittest
+import os
+import shutil
+import socket
+import threading
+import time
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+from cvra_packager.daemon import serve, request
+from os.path import join
+
+try:
+    from unittest.mock import *
+except ImportError:
+    # unittest.mock is only available in python >= 3.3
+    from mock import *
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets are required')
+class DaemonTestCase(WorkingDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.write_package('source: [pid.c]\n')
+
+        self.thread = threading.Thread(target=serve)
+        self.thread.start()
+
+        # Waits for the daemon to listen
+        for _ in range(100):
+            if os.path.exists(DAEMON_SOCKET):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        request('stop')
+        self.thread.join()
+        super().tearDown()
+
+    def write_package(self, content):
+        with open('package.yml', 'w') as f:
+            f.write(content)
+
+    def test_context(self):
+        """
+        Checks that the daemon returns the resolved context.
+        """
+        context = request('context')['context']
+        self.assertEqual(['./pid.c'], context['source'])
+        self.assertEqual([], context['include_directories.test'])
+
+    def test_context_is_invalidated(self):
+        """
+        Checks that changing a package file invalidates the context.
+        """
+        request('context')
+        self.write_package('source: [pid.c, filter.c]\n')
+
+        context = request('context')['context']
+        self.assertEqual(['./filter.c', './pid.c'], context['source'])
+
+    def test_render(self):
+        """
+        Checks that the daemon renders the build files.
+        """
+        self.write_package('tests: [pid_test.cpp]\n')
+        request('render')
+        self.assertTrue(os.path.exists('CMakeLists.txt'))
+
+    def test_removed_generated_files_are_written(self):
+        """
+        Checks that removing the build directory invalidates the context, so
+        that unity sources are written again.
+        """
+        self.write_package('source: [pid.c, filter.c]\nunity_build: True\n')
+        request('render')
+        unity = request('context')['context']['unity']['source']
+
+        shutil.rmtree('build')
+        request('render')
+
+        self.assertTrue(all(os.path.exists(f) for f in unity))
+
+    @patch('cvra_packager.daemon.request')
+    def test_main_falls_back_on_errors(self, request_mock):
+        """
+        Checks that packager renders the build files itself when the daemon
+        fails to render them.
+        """
+        from cvra_packager.packager import main as packager_main
+
+        request_mock.side_effect = RuntimeError('render failed')
+        self.write_package('tests: [pid_test.cpp]\n')
+
+        with patch('sys.argv', ['packager']):
+            packager_main()
+
+        self.assertTrue(os.path.exists('CMakeLists.txt'))
+
+    def test_errors_are_reported(self):
+        """
+        Checks that a failing request raises an error on the client side.
+        """
+        with self.assertRaises(RuntimeError):
+            request('foo')
+
+    def test_no_daemon(self):
+        """
+        Checks that requesting a daemon which does not run raises OSError.
+        """
+        with self.assertRaises(OSError):
+            request('context', socket_path='nothing.sock')
@@ -1,5 +1,9 @@
 import unittest
+import os
+import shutil
+import subprocess
 from cvra_packager.packager import *
+from .helpers import TemporaryDirectoryTestCase, WorkingDirectoryTestCase
 
 try:
     from unittest.mock import *
@@ -7,16 +11,55 @@ except ImportError:
     # unittest.mock is only available in python >= 3.3
     from mock import *
 
-class GitCloneTestCase(unittest.TestCase):
+class GitCloneTestCase(WorkingDirectoryTestCase):
     @patch('subprocess.call')
     def test_arguments_are_passed_correctly(self, call):
         url = 'https://github.com/cvra/pid'
         dest = 'dependencies/pid'
-        expected = 'git clone --recursive https://github.com/cvra/pid dependencies/pid'.split()
+        tmp = 'dependencies/.pid.tmp-{}'.format(os.getpid())
+        expected = 'git clone --recursive https://github.com/cvra/pid {}'.format(tmp).split()
         clone(url, dest)
         call.assert_called_with(expected)
 
-class GitSumboduleTestCase(unittest.TestCase):
+    @patch('subprocess.call')
+    def test_clone_is_renamed_to_dest(self, call):
+        """
+        Checks that the clone only appears at dest once it is complete.
+        """
+        def git_clone(command):
+            os.makedirs(command[-1])
+            return 0
+
+        call.side_effect = git_clone
+        clone('https://github.com/cvra/pid', 'dependencies/pid')
+
+        self.assertEqual(['.pid.lock', 'pid'], sorted(os.listdir('dependencies')))
+
+    @patch('subprocess.call')
+    def test_failed_clone_is_discarded(self, call):
+        """
+        Checks that a partial clone is not left behind when git fails.
+        """
+        def git_clone(command):
+            os.makedirs(command[-1])
+            return 128
+
+        call.side_effect = git_clone
+        clone('https://github.com/cvra/pid', 'dependencies/pid')
+
+        self.assertEqual(['.pid.lock'], os.listdir('dependencies'))
+
+    @patch('subprocess.call')
+    def test_existing_clone_is_reused(self, call):
+        """
+        Checks that a dependency cloned by another process while we were
+        waiting for the lock is not cloned again.
+        """
+        os.makedirs('dependencies/pid')
+        clone('https://github.com/cvra/pid', 'dependencies/pid')
+        call.assert_not_called()
+
+class GitSumboduleTestCase(WorkingDirectoryTestCase):
     @patch('subprocess.call')
     def test_arguments(self, call):
         url = 'https://github.com/cvra/pid'
@@ -25,3 +68,109 @@ class GitSumboduleTestCase(unittest.TestCase):
         submodule_add(url, dest)
         call.assert_called_with(expected)
 
+
+class SparseCheckoutTestCase(unittest.TestCase):
+    def test_is_sparse(self):
+        """
+        Checks that sparse checkouts are only used when asked for.
+        """
+        self.assertFalse(is_sparse("pid"))
+        self.assertFalse(is_sparse({"pid": {"fork": "antoinealb"}}))
+        self.assertTrue(is_sparse({"chibios": {"fork": "cvra", "sparse": True}}))
+
+    def test_patterns(self):
+        """
+        Checks that the patterns contain the package file, every listed file
+        and the include directories.
+        """
+        package = {'source': ['src/a.c'], 'target.arm': ['port/startup.s'],
+                   'include_directories': ['inc'], 'depends': ['pid']}
+        expected = ['/inc/', '/package.yml', '/port/startup.s', '/src/a.c']
+        self.assertEqual(expected, sparse_checkout_patterns(package))
+
+    def test_package_directory_is_fully_checked_out(self):
+        """
+        Checks that listing the package directory itself, for example as an
+        include directory, checks out every file.
+        """
+        package = {'include_directories': ['.', './']}
+        self.assertEqual(['/*', '/package.yml'], sparse_checkout_patterns(package))
+
+    def test_paths_outside_package_are_skipped(self):
+        """
+        Checks that paths leaving the package do not produce patterns.
+        """
+        package = {'include_directories': ['..', '../other/inc'], 'source': ['/abs.c']}
+        self.assertEqual(['/package.yml'], sparse_checkout_patterns(package))
+
+    @patch('cvra_packager.packager.sparse_checkout_update')
+    @patch('cvra_packager.packager.sparse_clone')
+    @patch('cvra_packager.packager.open_package')
+    @patch('os.path.exists')
+    def test_sparse_dependencies_are_sparse_cloned(self, exists, open_package,
+                                                   sparse_clone, update):
+        """
+        Checks that sparse dependencies are cloned sparsely then restricted to
+        the files listed in their package.yml.
+        """
+        exists.return_value = False
+        open_package.return_value = {'source': ['a.c']}
+        method = Mock()
+
+        package = {'depends': [{'chibios': {'fork': 'cvra', 'sparse': True}}]}
+        download_dependencies(package, method=method)
+
+        method.assert_not_called()
+        sparse_clone.assert_called_with('https://github.com/cvra/chibios', 'dependencies/chibios')
+        update.assert_called_with('dependencies/chibios', {'source': ['a.c']})
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is required')
+class SparseCheckoutIntegrationTestCase(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.upstream = os.path.join(self.directory, 'upstream')
+
+        for path in ['src/a.c', 'src/b.c', 'inc/a.h', 'vendor/huge.c']:
+            path = os.path.join(self.upstream, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        with open(os.path.join(self.upstream, 'package.yml'), 'w') as f:
+            f.write('source: [src/a.c]\ninclude_directories: [inc]\n')
+
+        git = ['git', '-C', self.upstream]
+        identity = ['-c', 'user.name=packager', '-c', 'user.email=packager@example.com']
+        subprocess.check_call(git + ['init', '-q'])
+        subprocess.check_call(git + ['add', '.'])
+        subprocess.check_call(git + identity + ['commit', '-q', '-m', 'initial'])
+
+    def test_only_used_files_are_checked_out(self):
+        """
+        Checks that only the package file and the files it lists are checked
+        out, and that the checkout is widened when the package file changes.
+        """
+        dest = os.path.join(self.directory, 'dest')
+        sparse_clone('file://' + self.upstream, dest)
+        self.assertEqual(['.git', 'package.yml'], sorted(os.listdir(dest)))
+
+        sparse_checkout_update(dest, {'source': ['src/a.c'], 'include_directories': ['inc']})
+        self.assertTrue(os.path.exists(os.path.join(dest, 'src', 'a.c')))
+        self.assertTrue(os.path.exists(os.path.join(dest, 'inc', 'a.h')))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'src', 'b.c')))
+        self.assertFalse(os.path.exists(os.path.join(dest, 'vendor')))
+
+        sparse_checkout_update(dest, {'source': ['src/a.c', 'src/b.c']})
+        self.assertTrue(os.path.exists(os.path.join(dest, 'src', 'b.c')))
+
+    def test_package_directory_include_checks_out_everything(self):
+        """
+        Checks that a package whose root is an include directory gets all its
+        headers.
+        """
+        dest = os.path.join(self.directory, 'dest')
+        sparse_clone('file://' + self.upstream, dest)
+
+        sparse_checkout_update(dest, {'include_directories': ['.']})
+        self.assertTrue(os.path.exists(os.path.join(dest, 'inc', 'a.h')))
+        self.assertTrue(os.path.exists(os.path.join(dest, 'vendor', 'huge.c')))
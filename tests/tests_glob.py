@@ -0,0 +1,135 @@
+import unittest
+import os
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+
+try:
+    from unittest.mock import *
+except ImportError:
+    # unittest.mock is only available in python >= 3.3
+    from mock import *
+
+
+class GlobToRegexTestCase(unittest.TestCase):
+    def assertMatches(self, pattern, path):
+        self.assertIsNotNone(glob_to_regex(pattern).match(path))
+
+    def assertNotMatches(self, pattern, path):
+        self.assertIsNone(glob_to_regex(pattern).match(path))
+
+    def test_star_does_not_cross_directories(self):
+        """
+        Checks that a single star only matches inside one directory.
+        """
+        self.assertMatches('*.c', 'pid.c')
+        self.assertNotMatches('*.c', 'src/pid.c')
+
+    def test_double_star_matches_any_depth(self):
+        """
+        Checks that **/ matches zero or more directories.
+        """
+        self.assertMatches('**/*.c', 'pid.c')
+        self.assertMatches('**/*.c', 'src/control/pid.c')
+        self.assertNotMatches('**/*.c', 'src/pid.h')
+
+    def test_question_mark_and_character_classes(self):
+        """
+        Checks the single character wildcards.
+        """
+        self.assertMatches('pid?.c', 'pid2.c')
+        self.assertMatches('pid[0-9].c', 'pid2.c')
+        self.assertNotMatches('pid[!0-9].c', 'pid2.c')
+
+    def test_other_characters_are_literal(self):
+        """
+        Checks that regular expression characters are escaped.
+        """
+        self.assertMatches('a+b.c', 'a+b.c')
+        self.assertNotMatches('*.c', 'pidxc')
+
+
+class ExpandGlobsTestCase(WorkingDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+
+        for path in ['src/pid.c', 'src/control/filter.c', 'src/pid.h',
+                     'src/.hidden.c', 'src/vendor/package.yml',
+                     'src/vendor/vendor.c', 'tests/pid_test.cpp']:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def test_plain_entries_are_kept(self):
+        """
+        Checks that entries which are not patterns are not checked against the
+        filesystem.
+        """
+        self.assertEqual(['missing.c'], expand_globs(['missing.c'], './'))
+
+    def test_recursive_pattern(self):
+        """
+        Checks that ** patterns find files in subdirectories, but skip hidden
+        files and nested packages.
+        """
+        result = expand_globs(['src/**/*.c'], './')
+        self.assertEqual(['src/control/filter.c', 'src/pid.c'], result)
+
+    def test_build_and_dependencies_are_skipped(self):
+        """
+        Checks that generated sources in the build directory and dependency
+        sources are not matched by the top-level package.
+        """
+        for path in ['build/unity/source_package_0.c', 'build/CMakeFiles/id/CMakeCCompilerId.c',
+                     'dependencies/pid/pid.c']:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+        result = generate_source_list({'source': ['**/*.c']}, 'source')
+
+        self.assertEqual(['./src/control/filter.c', './src/pid.c'], result)
+
+    def test_pattern_relative_to_basedir(self):
+        """
+        Checks that patterns are expanded relative to the package directory.
+        """
+        result = expand_globs(['*.c'], 'src')
+        self.assertEqual(['pid.c'], result)
+
+    def test_source_list_expands_globs(self):
+        """
+        Checks that generated source lists contain the expanded patterns.
+        """
+        package = {'source': ['src/*.c'], 'tests': ['tests/*_test.cpp']}
+        self.assertEqual(['./src/pid.c'], generate_source_list(package, 'source'))
+        self.assertEqual(['./tests/pid_test.cpp'], generate_source_list(package, 'tests'))
+
+    def test_include_directories_are_not_expanded(self):
+        """
+        Checks that include directories are kept as written.
+        """
+        package = {'include_directories': ['src/*']}
+        result = generate_source_list(package, 'include_directories')
+        self.assertEqual(['./src/*'], result)
+
+    def test_directories_are_scanned_once(self):
+        """
+        Checks that a directory is not scanned again while it did not change.
+        """
+        expand_globs(['src/**/*.c'], './')
+
+        with patch('os.scandir', side_effect=os.scandir) as scandir:
+            expand_globs(['src/**/*.c'], './')
+
+        self.assertFalse(scandir.called)
+
+    def test_new_files_are_found(self):
+        """
+        Checks that adding a file invalidates the cached scan.
+        """
+        expand_globs(['src/**/*.c'], './')
+
+        open('src/control/lowpass.c', 'w').close()
+        # Makes sure the mtime changes even on coarse grained filesystems
+        os.utime('src/control', ns=(0, 0))
+
+        result = expand_globs(['src/**/*.c'], './')
+        self.assertIn('src/control/lowpass.c', result)
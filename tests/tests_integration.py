@@ -50,7 +50,16 @@ class IntegrationTesting(unittest.TestCase):
         empty_context = {'source': [],
                          'target': {},
                          'tests': [],
-                         'include_directories': ['src']
+                         'include_directories': ['src'],
+                         'packages': [{'name': None,
+                                       'path': './',
+                                       'depends': (),
+                                       'source': (),
+                                       'tests': (),
+                                       'include_directories': (),
+                                       'include_directories.test': (),
+                                       }],
+                         'package_sources': [{'name': None, 'path': './', 'source': ()}],
                          }
 
         render_mock.assert_any_call('Makefile.jinja', 'Makefile', empty_context)
@@ -75,7 +84,16 @@ class IntegrationTesting(unittest.TestCase):
         expected_context = {'source': [],
                             'target': {},
                             'tests': [join('.','pid_test.cpp')],
-                            'include_directories': ['dependencies']
+                            'include_directories': ['dependencies'],
+                            'packages': [{'name': None,
+                                          'path': './',
+                                          'depends': (),
+                                          'source': (),
+                                          'tests': (join('.','pid_test.cpp'), ),
+                                          'include_directories': (),
+                                          'include_directories.test': (),
+                                          }],
+                            'package_sources': [{'name': None, 'path': './', 'source': ()}],
                             }
         render_mock.assert_any_call('CMakeLists.txt.jinja', 'CMakeLists.txt', expected_context)
 
@@ -101,6 +119,25 @@ class IntegrationTesting(unittest.TestCase):
 
         render_mock.assert_not_called()
 
+    @patch('cvra_packager.packager.render_template_to_file')
+    def test_ninja_build_can_be_enabled(self, render_mock):
+        """
+        Tests that a package can ask for a build.ninja to be generated.
+        """
+        from cvra_packager.packager import main as packager_main
+
+        pkgfile_content = '''
+        tests:
+            - pid_test.cpp
+
+        render_ninja: True
+        '''
+
+        with patch('cvra_packager.packager.open', mock_open(read_data=pkgfile_content), create=True):
+            packager_main()
+
+        render_mock.assert_any_call('build.ninja.jinja', 'build.ninja', ANY)
+
 
     def test_can_find_template(self):
         """
@@ -112,3 +149,19 @@ class IntegrationTesting(unittest.TestCase):
         env = create_jinja_env()
         template = env.get_template('CMakeLists.txt.jinja')
 
+
+class SubcommandParsingTestCase(unittest.TestCase):
+    def test_default_command(self):
+        """
+        Checks that no command means generating the build files.
+        """
+        args = parse_args([])
+        self.assertIsNone(args.command)
+
+    def test_outdated_command(self):
+        """
+        Checks that the outdated command and its job count are parsed.
+        """
+        args = parse_args('outdated -j 4'.split())
+        self.assertEqual('outdated', args.command)
+        self.assertEqual(4, args.jobs)
@@ -1,5 +1,11 @@
 import unittest
+import os
+import subprocess
+import sys
+import jinja2
+import jinja2.meta
 from cvra_packager.packager import *
+from .helpers import TemporaryDirectoryTestCase, WorkingDirectoryTestCase
 from os.path import join
 
 try:
@@ -95,3 +101,258 @@ class DependencyLocationBuilderTestCase(unittest.TestCase):
         self.assertEqual("control", locations["pid"])
         self.assertEqual("control", locations["odometry"])
         self.assertEqual("foo", locations["bar"])
+
+class IncrementalRenderingTestCase(WorkingDirectoryTestCase):
+    templates = {
+        'arm.jinja': '{% for f in target.arm %}{{ f }} {% endfor %}',
+        'all.jinja': '{% for arch, files in target.items() %}{{ files }}{% endfor %}',
+        'child.jinja': '{% extends "base.jinja" %}{% block b %}{{ tests }}{% endblock %}',
+        'base.jinja': '{{ include_directories.test }}{% block b %}{% endblock %}',
+        'root.jinja': '{% for f in packages[0].source %}{{ f }} {% endfor %}',
+        'cond.jinja': '{{ unity.source if unity else source }}',
+    }
+
+    def setUp(self):
+        super().setUp()
+
+        env = jinja2.Environment(loader=jinja2.DictLoader(self.templates))
+        patcher = patch('cvra_packager.packager.create_jinja_env', return_value=env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.context = generate_source_dict({'tests': ['a_test.cpp'],
+                                             'target.arm': ['arm.c'],
+                                             'target.x86': ['x86.c']})
+
+    def paths(self, template):
+        env = jinja2.Environment()
+        ast = env.parse(self.templates[template])
+        names = jinja2.meta.find_undeclared_variables(ast)
+        return template_context_paths(ast, names)
+
+    def test_attribute_paths(self):
+        """
+        Checks that reading an attribute only depends on this attribute.
+        """
+        self.assertEqual({('target', 'arm')}, self.paths('arm.jinja'))
+
+    def test_method_call_depends_on_whole_value(self):
+        """
+        Checks that calling a method on a value depends on all of it.
+        """
+        self.assertEqual({('target', )}, self.paths('all.jinja'))
+
+    def test_condition_depends_on_truth(self):
+        """
+        Checks that testing a value in a condition only depends on its truth.
+        """
+        expected = {('unity', '?'), ('unity', 'source'), ('source', )}
+        self.assertEqual(expected, self.paths('cond.jinja'))
+
+    @patch('cvra_packager.packager.write_file_if_changed', wraps=write_file_if_changed)
+    def test_unrelated_change_is_not_rendered(self, write_mock):
+        """
+        Checks that a template is not rendered again when only context values
+        it does not read changed.
+        """
+        render_template_to_file('arm.jinja', 'arm', self.context)
+        self.context['target']['x86'] = ['./other.c']
+        self.context['tests'].append('./b_test.cpp')
+        self.context['packages'][0]['tests'] += ('./b_test.cpp', )
+        render_template_to_file('arm.jinja', 'arm', self.context)
+
+        self.assertEqual(1, write_mock.call_count)
+
+    @patch('cvra_packager.packager.write_file_if_changed', wraps=write_file_if_changed)
+    def test_related_change_is_rendered(self, write_mock):
+        """
+        Checks that a template is rendered again when a value it reads
+        changed, including values read by the template it extends.
+        """
+        render_template_to_file('child.jinja', 'child', self.context)
+        self.context['include_directories'].test.append('mocks')
+        render_template_to_file('child.jinja', 'child', self.context)
+
+        self.assertEqual(2, write_mock.call_count)
+
+    @patch('cvra_packager.packager.write_file_if_changed', wraps=write_file_if_changed)
+    def test_list_index_change_is_rendered(self, write_mock):
+        """
+        Checks that values read through a constant list index, such as
+        packages[0], are part of the inputs.
+        """
+        render_template_to_file('root.jinja', 'root', self.context)
+        self.context['packages'][0]['source'] += ('./app.c', )
+        render_template_to_file('root.jinja', 'root', self.context)
+
+        self.assertEqual(2, write_mock.call_count)
+
+    @patch('cvra_packager.packager.write_file_if_changed', wraps=write_file_if_changed)
+    def test_deleted_output_is_rendered(self, write_mock):
+        """
+        Checks that an output file is rendered again if it was removed.
+        """
+        render_template_to_file('arm.jinja', 'arm', self.context)
+        os.remove('arm')
+        render_template_to_file('arm.jinja', 'arm', self.context)
+
+        self.assertTrue(os.path.exists('arm'))
+
+class BuiltinTemplatesRenderingTestCase(WorkingDirectoryTestCase):
+    @patch('cvra_packager.packager.write_file_if_changed', wraps=write_file_if_changed)
+    def test_new_test_does_not_render_target_makefile(self, write_mock):
+        """
+        Checks that adding a test file does not render the Makefile of a
+        target again, while adding one of its sources does.
+        """
+        context = generate_source_dict({'source': ['pid.c'],
+                                        'tests': ['pid_test.cpp'],
+                                        'target.arm': ['arm.c']})
+
+        render_template_to_file('Makefile.arm.jinja', 'Makefile.arm', context)
+        context['tests'].append('./filter_test.cpp')
+        context['packages'][0]['tests'] += ('./filter_test.cpp', )
+        render_template_to_file('Makefile.arm.jinja', 'Makefile.arm', context)
+        self.assertEqual(1, write_mock.call_count)
+
+        context['package_sources'][0]['source'] += ('./filter.c', )
+        render_template_to_file('Makefile.arm.jinja', 'Makefile.arm', context)
+        self.assertEqual(2, write_mock.call_count)
+
+class PackageCacheTestCase(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(os.path.join(self.directory, 'pid'))
+        self.pkgfile = os.path.join(self.directory, 'pid', 'package.yml')
+        self.filemap = {'pid': self.directory}
+
+        with open(self.pkgfile, 'w') as f:
+            f.write('source: [pid.c]\n')
+
+        patcher = patch('cvra_packager.packager._package_cache', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_packages_are_not_cached_by_default(self):
+        """
+        Checks that package files are not kept in memory unless a long running
+        process asks for it.
+        """
+        open_package('pid', self.filemap)
+
+        with patch('yaml.load') as load:
+            open_package('pid', self.filemap)
+
+        load.assert_called_once_with(ANY, Loader=ANY)
+
+    def test_unchanged_package_is_not_parsed_again(self):
+        """
+        Checks that an unchanged package file is only parsed once.
+        """
+        enable_package_cache()
+        open_package('pid', self.filemap)
+
+        with patch('yaml.load') as load:
+            result = open_package('pid', self.filemap)
+
+        load.assert_not_called()
+        self.assertEqual({'source': ['pid.c']}, result)
+
+    def test_changed_package_is_parsed_again(self):
+        """
+        Checks that a modified package file is parsed again.
+        """
+        enable_package_cache()
+        open_package('pid', self.filemap)
+
+        with open(self.pkgfile, 'w') as f:
+            f.write('source: [pid.c, filter.c]\n')
+
+        result = open_package('pid', self.filemap)
+        self.assertEqual({'source': ['pid.c', 'filter.c']}, result)
+
+
+class PrecompiledHeaderTestCase(TemporaryDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory, 'pch', 'precompiled.hpp')
+
+    def test_header_includes_every_header(self):
+        """
+        Checks that system headers are kept as is while package headers are
+        included relative to the generated header.
+        """
+        header = os.path.join(self.directory, 'tests', 'common.hpp')
+        write_precompiled_header(['<CppUTest/TestHarness.h>', header], self.path)
+
+        with open(self.path) as f:
+            content = f.read()
+
+        self.assertEqual('#include <CppUTest/TestHarness.h>\n'
+                         '#include "../tests/common.hpp"\n', content)
+
+    @patch('cvra_packager.packager.write_precompiled_header')
+    def test_targets_have_their_own_header(self, write_mock):
+        """
+        Checks that the precompiled header of the unit tests is kept apart
+        from the ones listed for each target.
+        """
+        write_mock.side_effect = lambda headers, path=PRECOMPILED_HEADER: path
+        package = {'precompiled_headers': ['<CppUTest/TestHarness.h>'],
+                   'precompiled_headers.arm': ['<cstdint>']}
+
+        context = generate_context(package, create_filemap(package))
+
+        arm = join('build', 'pch', 'arm', 'precompiled.hpp')
+        self.assertEqual(PRECOMPILED_HEADER, context['precompiled_header'])
+        self.assertEqual({'arm': arm}, context['target_precompiled_header'])
+        write_mock.assert_any_call(['<cstdint>'], arm)
+
+
+class LazyImportTestCase(unittest.TestCase):
+    def test_heavy_modules_are_not_imported(self):
+        """
+        Checks that importing the packager does not load the modules only
+        some commands need.
+        """
+        code = ('import sys, cvra_packager; '
+                'print(" ".join(m for m in ["yaml", "jinja2", "subprocess", "argparse"] '
+                'if m in sys.modules))')
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         universal_newlines=True)
+        self.assertEqual('', output.strip())
+
+
+class RenderCacheTestCase(WorkingDirectoryTestCase):
+    def setUp(self):
+        super().setUp()
+
+        with open('list.jinja', 'w') as f:
+            f.write('{{ tests }}')
+
+        self.context = {'tests': ['./a_test.cpp']}
+
+    def test_up_to_date_output_does_not_load_templates(self):
+        """
+        Checks that the templates are not parsed when nothing changed.
+        """
+        render_template_to_file('list.jinja', 'list', self.context)
+
+        with patch('cvra_packager.packager.create_jinja_env') as env_mock:
+            render_template_to_file('list.jinja', 'list', self.context)
+
+        env_mock.assert_not_called()
+
+    def test_changed_template_is_rendered(self):
+        """
+        Checks that editing the template renders it again.
+        """
+        render_template_to_file('list.jinja', 'list', self.context)
+
+        with open('list.jinja', 'w') as f:
+            f.write('{{ tests | length }}')
+
+        render_template_to_file('list.jinja', 'list', self.context)
+
+        with open('list') as f:
+            self.assertEqual('1', f.read())
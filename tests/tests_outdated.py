@@ -0,0 +1,137 @@
+import unittest
+import os
+import shutil
+import subprocess
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+from os.path import join
+
+try:
+    from unittest.mock import *
+except ImportError:
+    # unittest.mock is only available in python >= 3.3
+    from mock import *
+
+
+def git(*args):
+    identity = ['-c', 'user.name=packager', '-c', 'user.email=packager@example.com']
+    subprocess.check_call(['git'] + identity + list(args),
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@unittest.skipUnless(shutil.which('git'), 'git is required')
+class OutdatedDependenciesTestCase(WorkingDirectoryTestCase):
+    """
+    Uses local bare repositories as remotes of the dependencies.
+    """
+    def setUp(self):
+        super().setUp()
+
+        self.package = {'depends': []}
+
+        for name in ['pid', 'odometry']:
+            remote = join(self.directory, 'remotes', name + '.git')
+            work = join(self.directory, 'work', name)
+            git('init', '-q', '--bare', remote)
+            git('clone', '-q', remote, work)
+            self.commit(name)
+            git('clone', '-q', remote, join('dependencies', name))
+            self.package['depends'].append({name: {'url': remote}})
+
+    def commit(self, name):
+        """
+        Pushes a new commit to the remote of the given dependency.
+        """
+        work = join(self.directory, 'work', name)
+        git('-C', work, 'commit', '-q', '--allow-empty', '-m', 'change')
+        git('-C', work, 'push', '-q', 'origin', 'HEAD')
+
+    def test_read_git_head(self):
+        """
+        Checks that the checked out branch and commit are read correctly.
+        """
+        branch, commit = read_git_head(join('dependencies', 'pid'))
+        expected = subprocess.check_output(['git', '-C', join('dependencies', 'pid'),
+                                            'rev-parse', 'HEAD'])
+        self.assertEqual(expected.decode().strip(), commit)
+        self.assertIsNotNone(branch)
+
+    def test_up_to_date(self):
+        """
+        Checks that no dependency is reported when remotes did not move.
+        """
+        self.assertEqual([], find_outdated_dependencies(self.package))
+
+    def test_outdated(self):
+        """
+        Checks that only the dependencies whose remote moved are reported.
+        """
+        self.commit('odometry')
+        result = find_outdated_dependencies(self.package)
+        self.assertEqual([join('dependencies', 'odometry')], [r[1] for r in result])
+
+    def test_local_commits_are_not_outdated(self):
+        """
+        Checks that a dependency ahead of its remote is not reported.
+        """
+        git('-C', join('dependencies', 'pid'), 'commit', '-q', '--allow-empty', '-m', 'local')
+        self.assertEqual([], find_outdated_dependencies(self.package))
+
+    def test_diverged_is_not_outdated(self):
+        """
+        Checks that a dependency which cannot be fast-forwarded is not
+        reported.
+        """
+        git('-C', join('dependencies', 'pid'), 'commit', '-q', '--allow-empty', '-m', 'local')
+        self.commit('pid')
+        self.assertEqual([], find_outdated_dependencies(self.package))
+
+    def test_update(self):
+        """
+        Checks that updating fast-forwards the outdated dependencies.
+        """
+        self.commit('pid')
+        updated, failed = update_dependencies(self.package)
+
+        self.assertEqual([join('dependencies', 'pid')], [r[1] for r in updated])
+        self.assertEqual([], failed)
+        self.assertEqual([], find_outdated_dependencies(self.package))
+
+    def test_update_failure_is_reported(self):
+        """
+        Checks that a dependency which could not be pulled is reported as
+        failed.
+        """
+        self.commit('pid')
+        outdated = find_outdated_dependencies(self.package)
+        shutil.rmtree(join(self.directory, 'remotes', 'pid.git'))
+
+        with patch('cvra_packager.packager.find_outdated_dependencies') as find_mock:
+            find_mock.return_value = outdated
+            updated, failed = update_dependencies(self.package)
+
+        self.assertEqual([], updated)
+        self.assertEqual(outdated, failed)
+
+    def test_vendored_dependency_is_skipped(self):
+        """
+        Checks that a dependency which is not a git repository is skipped and
+        reported, without stopping the others from being checked.
+        """
+        os.makedirs(join('dependencies', 'vendored'))
+        self.package['depends'].append('vendored')
+        self.commit('pid')
+        skipped = list()
+
+        result = find_outdated_dependencies(self.package, skipped=skipped)
+
+        self.assertEqual([join('dependencies', 'pid')], [r[1] for r in result])
+        self.assertEqual([('vendored', join('dependencies', 'vendored'))], skipped)
+
+    def test_detached_head_is_skipped(self):
+        """
+        Checks that pinned dependencies are never reported.
+        """
+        git('-C', join('dependencies', 'pid'), 'checkout', '-q', '--detach')
+        self.commit('pid')
+        self.assertEqual([], find_outdated_dependencies(self.package))
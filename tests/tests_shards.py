@@ -0,0 +1,116 @@
+import unittest
+from cvra_packager.packager import *
+
+try:
+    from unittest.mock import *
+except ImportError:
+    # unittest.mock is only available in python >= 3.3
+    from mock import *
+
+
+class TestShardsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packages = [
+            {'name': None, 'tests': ['a_test.cpp', 'b_test.cpp', 'c_test.cpp']},
+            {'name': 'pid', 'tests': ['pid/pid_test.cpp']},
+            {'name': 'math', 'tests': []},
+        ]
+
+    def test_round_robin(self):
+        """
+        Checks that tests are dealt one by one to the shards.
+        """
+        result = generate_test_shards(self.packages, 2)
+        expected = [['a_test.cpp', 'c_test.cpp'], ['b_test.cpp', 'pid/pid_test.cpp']]
+        self.assertEqual(expected, result)
+
+    def test_by_package(self):
+        """
+        Checks that the tests of a package are kept in the same shard.
+        """
+        result = generate_test_shards(self.packages, 2, "package")
+        expected = [['a_test.cpp', 'b_test.cpp', 'c_test.cpp'], ['pid/pid_test.cpp']]
+        self.assertEqual(expected, result)
+
+    def test_empty_shards_are_dropped(self):
+        """
+        Checks that asking for more shards than possible does not create
+        empty executables.
+        """
+        result = generate_test_shards(self.packages, 8, "package")
+        self.assertEqual(2, len(result))
+
+    def test_test_main_is_in_every_shard(self):
+        """
+        Checks that the test runner main is compiled in every shard instead of
+        being split with the tests.
+        """
+        self.packages.append({'name': 'test-runner', 'tests': ['runner/main.cpp']})
+
+        for method in ["round-robin", "package"]:
+            result = generate_test_shards(self.packages, 2, method)
+            self.assertEqual(2, len(result))
+            for shard in result:
+                self.assertEqual(1, shard.count('runner/main.cpp'))
+
+    def test_custom_test_main(self):
+        """
+        Checks that the names of the files defining main can be configured.
+        """
+        self.packages.append({'name': 'test-runner', 'tests': ['runner/runner.cpp']})
+        result = generate_test_shards(self.packages, 2, test_main=['runner.cpp'])
+        self.assertTrue(all('runner/runner.cpp' in shard for shard in result))
+
+    def test_unknown_method_raises(self):
+        """
+        Checks that an invalid sharding method raises a ValueError.
+        """
+        with self.assertRaises(ValueError):
+            generate_test_shards(self.packages, 2, "random")
+
+    def test_cmake_runs_shards_in_parallel(self):
+        """
+        Checks that each shard gets its executable and that check runs all of
+        them in parallel through CTest.
+        """
+        context = generate_source_dict({'source': ['app.c'], 'tests': ['a_test.cpp', 'b_test.cpp']})
+        context['test_shards'] = [['./a_test.cpp'], ['./b_test.cpp']]
+
+        env = create_jinja_env()
+        result = env.get_template('CMakeLists.txt.jinja').render(context)
+
+        self.assertIn('add_executable(\n    tests_0', result)
+        self.assertIn('add_executable(\n    tests_1', result)
+        self.assertIn('add_test(NAME tests_1 COMMAND tests_1 -c)', result)
+        self.assertIn('${CMAKE_CTEST_COMMAND} --output-on-failure -j 2', result)
+
+    @patch('cvra_packager.packager.render_template_to_file')
+    def test_shards_are_in_context(self, render_mock):
+        """
+        Checks that setting test_shards in package.yml adds the shards to the
+        template context.
+        """
+        from cvra_packager.packager import main as packager_main
+
+        pkgfile_content = '''
+        tests:
+            - a_test.cpp
+            - b_test.cpp
+        test_shards: 2
+        '''
+
+        with patch('cvra_packager.packager.open', mock_open(read_data=pkgfile_content), create=True):
+            packager_main()
+
+        context = render_mock.call_args[0][2]
+        self.assertEqual([['./a_test.cpp'], ['./b_test.cpp']], context['test_shards'])
+
+    def test_invalid_shard_count_raises(self):
+        """
+        Checks that a test_shards value which is not a positive integer raises
+        a ValueError instead of failing while splitting the tests.
+        """
+        for count in (0, -2, 1.5, "2", True):
+            package = {'tests': ['a_test.cpp'], 'test_shards': count}
+            with self.assertRaisesRegex(ValueError, 'test_shards'):
+                generate_context(package, create_filemap(package))
@@ -145,3 +145,80 @@ class GenerateSourceListTestCase(unittest.TestCase):
         expected = [os.path.join(DEPENDENCIES_DIR, 'pid', 'poney')]
 
         self.assertEqual(result['include_directories'].test, expected)
+
+
+class PackageListTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packages = {
+            'pid': {'source': ['pid.c'], 'depends': ['math']},
+            'odometry': {'source': ['odometry.c'], 'depends': ['math']},
+            'math': {'source': ['math.c'], 'include_directories': ['inc']},
+        }
+
+    @patch('cvra_packager.packager.open_package')
+    def test_packages_are_topologically_sorted(self, open_package_mock):
+        """
+        Checks that every package comes before its dependencies and that
+        diamond dependencies appear only once.
+        """
+        open_package_mock.side_effect = lambda pkg, filemap: self.packages[pkg]
+        package = {'source': ['app.c'], 'depends': ['pid', 'odometry']}
+
+        result = [pkg['name'] for pkg in generate_package_list(package)]
+
+        self.assertEqual(None, result[0])
+        self.assertEqual(4, len(result))
+        self.assertLess(result.index('pid'), result.index('math'))
+        self.assertLess(result.index('odometry'), result.index('math'))
+
+    @patch('cvra_packager.packager.open_package')
+    def test_package_has_its_own_files(self, open_package_mock):
+        """
+        Checks that each package only lists its own files.
+        """
+        open_package_mock.side_effect = lambda pkg, filemap: self.packages[pkg]
+        package = {'source': ['app.c'], 'depends': ['math']}
+
+        app, math = generate_package_list(package)
+
+        self.assertEqual(('./app.c', ), app['source'])
+        self.assertEqual(('math', ), app['depends'])
+        self.assertEqual((join('dependencies', 'math', 'math.c'), ), math['source'])
+        self.assertEqual((join('dependencies', 'math', 'inc'), ), math['include_directories'])
+        self.assertEqual((), math['tests'])
+
+    def test_source_dict_contains_packages(self):
+        """
+        Checks that the package list is part of the source dictionary.
+        """
+        result = generate_source_dict({'source': ['app.c']})
+        self.assertEqual(('./app.c', ), result['packages'][0]['source'])
+
+    @patch('cvra_packager.packager.open_package')
+    def test_graph_nodes_are_compact(self, open_package_mock):
+        """
+        Checks that graph nodes have no instance dictionary and store their
+        files as tuples.
+        """
+        open_package_mock.side_effect = lambda pkg, filemap: self.packages[pkg]
+        package = {'source': ['app.c'], 'depends': ['pid', 'odometry']}
+
+        app, pid, odometry, math = resolve_package_graph(package)
+
+        self.assertFalse(hasattr(app, '__dict__'))
+        self.assertEqual(('./app.c', ), app.files['source'])
+        self.assertEqual(('pid', 'odometry'), app.depends)
+        self.assertEqual('math', math.name)
+
+    @patch('cvra_packager.packager.open_package')
+    def test_context_lists_share_paths(self, open_package_mock):
+        """
+        Checks that a path appearing in several lists of the context is stored
+        only once.
+        """
+        open_package_mock.side_effect = lambda pkg, filemap: self.packages[pkg]
+        package = {'source': ['app.c'], 'depends': ['math']}
+
+        result = generate_source_dict(package)
+
+        self.assertIs(result['packages'][0]['source'][0], result['source'][0])
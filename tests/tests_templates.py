@@ -0,0 +1,274 @@
+import unittest
+import os
+import shutil
+import subprocess
+from cvra_packager.packager import *
+from .helpers import WorkingDirectoryTestCase
+from os.path import join
+
+
+def render(template_name, context):
+    """
+    Renders one of the builtin templates with the given context.
+    """
+    env = create_jinja_env()
+    return env.get_template(template_name).render(context)
+
+
+class ObjectPathTestCase(unittest.TestCase):
+    def test_object_is_in_build_dir(self):
+        """
+        Checks that objects are placed in the build directory.
+        """
+        self.assertEqual(join('build', 'pid.c.o'), object_path('./pid.c', 'build'))
+
+    def test_object_keeps_source_directories(self):
+        """
+        Checks that two sources with the same name in different packages do
+        not produce the same object.
+        """
+        a = object_path(join('dependencies', 'a', 'main.c'), 'build')
+        b = object_path(join('dependencies', 'b', 'main.c'), 'build')
+        self.assertNotEqual(a, b)
+
+    def test_object_never_escapes_build_dir(self):
+        """
+        Checks that sources outside of the package still get their object in
+        the build directory.
+        """
+        result = object_path(join('..', 'lib', 'pid.c'), 'build')
+        self.assertEqual(join('build', '__', 'lib', 'pid.c.o'), result)
+
+
+class NinjaTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = generate_source_dict({'source': ['pid.c'],
+                                             'tests': ['pid_test.cpp'],
+                                             'include_directories': ['inc'],
+                                             'include_directories.test': ['mocks'],
+                                             'target.arm': ['startup.s']})
+
+    def test_build_dir_is_not_shared(self):
+        """
+        Checks that ninja does not write its outputs in the CMake build
+        directory.
+        """
+        result = render('build.ninja.jinja', self.context)
+        self.assertIn('builddir = build/ninja\n', result)
+
+    def test_depfiles_are_used(self):
+        """
+        Checks that the compile rules ask ninja to track headers.
+        """
+        result = render('build.ninja.jinja', self.context)
+        self.assertIn('deps = gcc', result)
+        self.assertIn('depfile = $out.d', result)
+
+    def test_tests_executable(self):
+        """
+        Checks that sources and tests are compiled into the tests executable,
+        with the test include directories.
+        """
+        result = render('build.ninja.jinja', self.context)
+        self.assertIn('build $builddir/tests.dir/pid.c.o: tests_cc ./pid.c', result)
+        self.assertIn('build $builddir/tests.dir/pid_test.cpp.o: tests_cxx ./pid_test.cpp', result)
+        self.assertIn('-I./inc -I./mocks', result)
+        self.assertIn('build check: run_tests $builddir/tests', result)
+
+    def test_target_output(self):
+        """
+        Checks that each target gets its own objects, toolchain and output.
+        """
+        result = render('build.ninja.jinja', self.context)
+        self.assertIn('build $builddir/arm.dir/pid.c.o: arm_cc ./pid.c', result)
+        self.assertIn('build $builddir/arm.dir/startup.s.o: arm_as ./startup.s', result)
+        self.assertIn('arm-none-eabi-gcc', result)
+        self.assertIn('build $builddir/arm.elf: arm_link', result)
+        self.assertIn('default tests arm', result)
+
+
+class MakefileTemplateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = generate_source_dict({'source': ['pid.c', 'filter.cpp'],
+                                             'target.arm': ['startup.s'],
+                                             'target.x86': ['main.c']})
+
+    def test_objects_are_in_target_build_dir(self):
+        """
+        Checks that each target compiles its objects in its own directory.
+        """
+        arm = render('Makefile.arm.jinja', self.context)
+        x86 = render('Makefile.x86.jinja', self.context)
+        self.assertIn('BUILDDIR = build/arm', arm)
+        self.assertIn('BUILDDIR = build/x86', x86)
+        self.assertIn('$(call objects,$(CSRC)', arm)
+
+    def test_dependency_files_are_included(self):
+        """
+        Checks that compilers generate dependency files which are then
+        included by make.
+        """
+        result = render('Makefile.x86.jinja', self.context)
+        self.assertIn('-MMD -MP', result)
+        self.assertIn('-include $(DEPS)', result)
+
+    def test_every_source_kind_is_compiled(self):
+        """
+        Checks that C++ and assembly sources get their own variable and rule.
+        """
+        result = render('Makefile.arm.jinja', self.context)
+        self.assertIn('CXXSRC += ./filter.cpp', result)
+        self.assertIn('ASMSRC += ./startup.s', result)
+        self.assertIn('$(BUILDDIR)/%.cpp.o: %.cpp', result)
+        self.assertIn('$(BUILDDIR)/%.s.o: %.s', result)
+
+    def test_cc_and_cxx_sources_are_compiled(self):
+        """
+        Checks that the other C++ extensions are compiled as C++.
+        """
+        self.context = generate_source_dict({'source': ['pid.cc'],
+                                             'target.x86': ['main.cxx']})
+        result = render('Makefile.x86.jinja', self.context)
+        self.assertIn('CXXSRC += ./pid.cc', result)
+        self.assertIn('CXXSRC += ./main.cxx', result)
+        self.assertIn('$(BUILDDIR)/%.cc.o: %.cc', result)
+        self.assertIn('$(BUILDDIR)/%.cxx.o: %.cxx', result)
+
+    def test_outside_objects_stay_in_build_dir(self):
+        """
+        Checks that objects of sources outside of the package are mangled like
+        the ninja ones, and get a rule of their own.
+        """
+        result = render('Makefile.x86.jinja', self.context)
+        self.assertIn('objects = $(patsubst %,$(BUILDDIR)/%.o,$(subst ..,__,$(1)))', result)
+        self.assertIn('OBJS = $(call objects,$(CSRC) $(ASMSRC) $(CXXSRC))', result)
+        self.assertIn('$(eval $(call outside_rule,$(src),$$(CC),$$(CFLAGS)))', result)
+
+    def test_app_is_linked_in_build_dir(self):
+        """
+        Checks that the application is linked by the C++ driver in the build
+        directory of the target.
+        """
+        result = render('Makefile.base.jinja', self.context)
+        self.assertIn('LD=@g++', result)
+        self.assertIn('all: $(BUILDDIR)/app', result)
+        self.assertIn('-o ${@}\n', result)
+
+
+@unittest.skipUnless(shutil.which('make'), 'make is required')
+class MakefileOutsideSourcesTestCase(WorkingDirectoryTestCase):
+    def test_targets_do_not_share_objects(self):
+        """
+        Checks that make compiles dependencies living outside of the package
+        into the build directory of each target.
+        """
+        os.makedirs(join('deps', 'pid'))
+        os.makedirs('app')
+        open(join('deps', 'pid', 'pid.c'), 'w').close()
+        open(join('app', 'main.c'), 'w').close()
+        os.chdir('app')
+
+        context = generate_source_dict({'target.x86': ['main.c']})
+        context['package_sources'].append({'name': 'pid', 'path': '../deps/pid',
+                                           'source': ('../deps/pid/pid.c', )})
+
+        with open('Makefile', 'w') as f:
+            f.write(render('Makefile.x86.jinja', context))
+
+        output = subprocess.check_output(['make', '-n'], stderr=subprocess.STDOUT)
+        self.assertIn('-o build/x86/__/deps/pid/pid.c.o', output.decode())
+
+
+class StaticLibrariesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.packages = [
+            {'name': None, 'source': ['./app.c']},
+            {'name': 'pid', 'source': ['pid/pid.c', 'pid/pid.h']},
+            {'name': 'headers', 'source': ['headers/config.h']},
+            {'name': 'math', 'source': ['math/math.c']},
+        ]
+
+    def test_header_only_packages_are_skipped(self):
+        """
+        Checks that packages without any compiled source do not get a library.
+        """
+        result = [pkg['name'] for pkg in static_libraries(self.packages)]
+        self.assertEqual(['pid', 'math'], result)
+
+    def test_cmake_links_libraries_in_order(self):
+        """
+        Checks that CMake builds one library per dependency and links them in
+        dependency order.
+        """
+        context = generate_source_dict({'tests': ['app_test.cpp']})
+        context['package_sources'] = self.packages
+
+        result = render('CMakeLists.txt.jinja', context)
+
+        self.assertIn('add_library(\n    pid\n    STATIC', result)
+        self.assertNotIn('add_library(\n    headers', result)
+        self.assertLess(result.index('    pid\n    math\n    m\n'),
+                        result.index('CppUTest'))
+
+
+class CompilerCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.context = generate_source_dict({'source': ['pid.c', 'filter.cpp'],
+                                             'tests': ['pid_test.cpp'],
+                                             'target.arm': ['startup.s']})
+        self.context['compiler_launcher'] = 'ccache'
+        self.context['precompiled_header'] = 'build/pch/precompiled.hpp'
+
+    def test_cmake_uses_launcher_and_header(self):
+        """
+        Checks that CMake compiles through the launcher and precompiles the
+        header for the tests executable.
+        """
+        result = render('CMakeLists.txt.jinja', self.context)
+        self.assertIn('set(CMAKE_C_COMPILER_LAUNCHER ccache)', result)
+        self.assertIn('set(CMAKE_CXX_COMPILER_LAUNCHER ccache)', result)
+        self.assertIn('target_precompile_headers(tests PRIVATE', result)
+        self.assertIn('if(COMMAND target_precompile_headers)', result)
+
+    def test_makefile_uses_launcher_and_header(self):
+        """
+        Checks that the Makefiles compile through the launcher and include the
+        precompiled header of their target in C++ sources.
+        """
+        self.context['target_precompiled_header'] = {'arm': 'build/pch/arm/precompiled.hpp'}
+        result = render('Makefile.arm.jinja', self.context)
+        self.assertIn('CPP := ccache $(CPP:@%=%)', result)
+        self.assertIn('PCH = build/pch/arm/precompiled.hpp', result)
+        self.assertIn('PCH_FLAGS = -include $(PCH)', result)
+        self.assertIn('$(filter %.cpp.o %.cc.o %.cxx.o,$(OBJS) $(LIB_OBJS)): $(PCH_GCH)', result)
+
+    def test_makefile_ignores_tests_header(self):
+        """
+        Checks that the precompiled header of the unit tests is not included
+        in the sources of a target.
+        """
+        result = render('Makefile.arm.jinja', self.context)
+        self.assertNotIn('PCH =', result)
+
+    def test_ninja_uses_launcher_and_header(self):
+        """
+        Checks that every ninja build compiles through the launcher and
+        precompiles its own header.
+        """
+        self.context['target_precompiled_header'] = {'arm': 'build/pch/arm/precompiled.hpp'}
+        result = render('build.ninja.jinja', self.context)
+        self.assertIn('command = ccache arm-none-eabi-gcc', result)
+        self.assertIn('-include build/pch/precompiled.hpp -c $in', result)
+        self.assertIn('-include build/pch/arm/precompiled.hpp -c $in', result)
+        self.assertIn('build build/pch/arm/precompiled.hpp.gch/ninja-arm.gch: arm_pch', result)
+        self.assertIn('tests_cxx ./filter.cpp | build/pch/precompiled.hpp.gch/ninja-tests.gch', result)
+
+    def test_ninja_target_ignores_tests_header(self):
+        """
+        Checks that the precompiled header of the unit tests is not included
+        in the sources of a target.
+        """
+        result = render('build.ninja.jinja', self.context)
+        self.assertIn('-include build/pch/precompiled.hpp -c $in', result)
+        self.assertNotIn('ninja-arm.gch', result)
+        self.assertIn('arm_cxx ./filter.cpp\n', result)
\ No newline at end of file
@@ -0,0 +1,137 @@
+import unittest
+from cvra_packager.packager import *
+from .helpers import TemporaryDirectoryTestCase
+from os.path import join
+
+try:
+    from unittest.mock import *
+except ImportError:
+    # unittest.mock is only available in python >= 3.3
+    from mock import *
+
+
+class UnityBatchesTestCase(unittest.TestCase):
+    def test_batches_have_bounded_size(self):
+        """
+        Checks that sources are split in batches of at most batch_size files.
+        """
+        sources = ['a.c', 'b.c', 'c.c']
+        result = unity_batches(sources, 2)
+        self.assertEqual([('c', ['a.c', 'b.c']), ('c', ['c.c'])], result)
+
+    def test_languages_are_not_mixed(self):
+        """
+        Checks that C and C++ files end up in different batches.
+        """
+        result = unity_batches(['a.c', 'b.cpp'], 8)
+        self.assertEqual([('c', ['a.c']), ('cpp', ['b.cpp'])], result)
+
+    def test_other_files_are_left_alone(self):
+        """
+        Checks that assembly files are not batched.
+        """
+        result = unity_batches(['startup.s', 'a.c'], 8)
+        self.assertEqual([('c', ['a.c']), (None, ['startup.s'])], result)
+
+
+class UnitySourcesTestCase(TemporaryDirectoryTestCase):
+    def test_wrapper_includes_batch(self):
+        """
+        Checks that a wrapper including every source of the batch is written.
+        """
+        package = {'source': ['a.c', 'b.c']}
+        result = generate_unity_dict(package, 8, directory=self.directory)['source']
+
+        self.assertEqual([join(self.directory, 'source_package_0.c')], result)
+
+        with open(result[0]) as f:
+            content = f.read()
+
+        a = os.path.relpath('a.c', self.directory)
+        self.assertIn('#include "{}"'.format(a), content)
+
+    def test_single_file_batch_is_not_wrapped(self):
+        """
+        Checks that batches of a single file are compiled directly.
+        """
+        package = {'source': ['a.c', 'startup.s']}
+        result = generate_unity_dict(package, 8, directory=self.directory)['source']
+        self.assertEqual(['./a.c', './startup.s'], result)
+
+    @patch('cvra_packager.packager.open_package')
+    def test_sources_are_batched_per_package(self, open_package_mock):
+        """
+        Checks that sources are batched by package, and that a dependency
+        reached twice (diamond dependency) only appears once.
+        """
+        package = {'source': ['app.c'], 'depends': ['pid', 'odometry']}
+        packages = {
+            'pid': {'source': ['pid.c'], 'depends': ['odometry']},
+            'odometry': {'source': ['odometry.c']},
+        }
+        open_package_mock.side_effect = lambda pkg, filemap: packages[pkg]
+
+        result = generate_unity_dict(package, 8, directory=self.directory)
+
+        expected = [
+            ('./', ('./app.c', )),
+            (join('dependencies', 'pid'), (join('dependencies', 'pid', 'pid.c'), )),
+            (join('dependencies', 'odometry'), (join('dependencies', 'odometry', 'odometry.c'), )),
+        ]
+        self.assertEqual(expected, [(pkg['path'], pkg['source']) for pkg in result['packages']])
+
+    def test_unity_sources_are_used_by_templates(self):
+        """
+        Checks that the builtin templates compile unity sources when available.
+        """
+        context = generate_source_dict({'source': ['a.c'], 'tests': ['a_test.cpp']})
+        context['unity'] = {'source': ['unity_0.c'], 'tests': ['unity_1.cpp'], 'target': {},
+                            'package_sources': [{'name': None, 'source': ['unity_0.c']}]}
+
+        env = create_jinja_env()
+        result = env.get_template('CMakeLists.txt.jinja').render(context)
+
+        self.assertIn('unity_0.c', result)
+        self.assertNotIn('./a.c', result)
+
+    @patch('cvra_packager.packager.open_package')
+    def test_unity_sources_per_package(self, open_package_mock):
+        """
+        Checks that the unity dictionary keeps batches grouped per package.
+        """
+        open_package_mock.return_value = {'source': ['pid.c', 'filter.c']}
+        package = {'source': ['app.c'], 'depends': ['pid']}
+
+        result = generate_unity_dict(package, 8, directory=self.directory)
+
+        app, pid = result['packages']
+        self.assertEqual(('./app.c', ), app['source'])
+        self.assertEqual((join(self.directory, 'source_dependencies_pid_0.c'), ), pid['source'])
+        self.assertEqual(sorted(app['source'] + pid['source']), result['source'])
+
+    def test_test_main_is_not_batched(self):
+        """
+        Checks that the file defining the test main stays out of unity
+        batches, so that every test shard can include it.
+        """
+        package = {'tests': ['main.cpp', 'a_test.cpp', 'b_test.cpp']}
+
+        result = generate_unity_dict(package, 8, directory=self.directory)
+
+        self.assertEqual(sorted([join(self.directory, 'tests_package_0.cpp'), './main.cpp']),
+                         result['tests'])
+
+    @patch('cvra_packager.packager.generate_package_list')
+    def test_given_packages_are_not_resolved_again(self, package_list_mock):
+        """
+        Checks that the package list of the context is reused instead of
+        walking the dependency graph a second time.
+        """
+        package = {'source': ['a.c', 'b.c']}
+        packages = generate_source_dict(package)['packages']
+
+        result = generate_unity_dict(package, 8, directory=self.directory,
+                                     packages=packages)
+
+        package_list_mock.assert_not_called()
+        self.assertEqual([join(self.directory, 'source_package_0.c')], result['source'])